@@ -0,0 +1,236 @@
+"""
+Offline end-to-end benchmark of the processing endpoints against the stub backend.
+
+Starts benchmarks/stub_server.py, seeds a fresh database with synthetic schemas and examples,
+runs the application in-process and reports throughput, latency percentiles, peak RSS
+and the number of backend requests for every scenario.
+
+    python -m benchmarks.run --rows 2000 --chat-latency-ms 100
+"""
+from contextlib import asynccontextmanager
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.stub_server import build_parser as build_stub_parser
+
+TYPE_NAMES = ["телефон", "ноутбук", "холодильник", "телевизор", "пылесос", "чайник", "планшет", "монитор"]
+ATTRIBUTE_NAMES = ["бренд", "модель", "цвет", "размер", "вес", "материал", "мощность", "объем"]
+BRANDS = ["samsung", "apple", "xiaomi", "lg", "bosch", "philips", "sony", "asus"]
+SCENARIOS = ["normalize_text", "normalize_xlsx", "validate_normalization"]
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def synthetic_types(count: int) -> list[str]:
+    return [TYPE_NAMES[i % len(TYPE_NAMES)] + (str(i // len(TYPE_NAMES)) if i >= len(TYPE_NAMES) else "") for i in range(count)]
+
+def synthetic_text(rng: random.Random, type: str) -> str:
+    return f"{type} {rng.choice(BRANDS)} {rng.choice('abcdefxyz')}{rng.randint(1, 9999)}"
+
+def synthetic_rows(rng: random.Random, types: list[str], count: int, duplicate_ratio: float) -> list[str]:
+    """
+    Returns `count` texts, about `duplicate_ratio` of them repeat an earlier text with different case or spacing.
+    """
+    rows = []
+    for _ in range(count):
+        if rows and rng.random() < duplicate_ratio:
+            rows.append(rng.choice(rows).upper().replace(" ", "  "))
+        else:
+            rows.append(synthetic_text(rng, rng.choice(types)))
+    return rows
+
+def build_xlsx(rows: list[list]) -> bytes:
+    import pandas as pd
+
+    output = io.BytesIO()
+    pd.DataFrame(rows).to_excel(output, header=False, index=False)
+    return output.getvalue()
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def seed_database(rng: random.Random, types: list[str], attributes: list[str], examples_per_type: int, value: str):
+    from src.database.sqlite import Base, engine, get_session, Schema, Example
+
+    Base.metadata.create_all(bind=engine)
+    with get_session() as session:
+        session.add_all([Schema(type=type, attributes=attributes) for type in types])
+        session.add_all([
+            Example(type=type, unnormalized_text=synthetic_text(rng, type), normalized_json={attribute: value for attribute in attributes})
+            for type in types
+            for _ in range(examples_per_type)
+        ])
+
+@asynccontextmanager
+async def stub_backend(args: argparse.Namespace):
+    stub_args = [
+        "--port", str(args.port),
+        "--chat-latency-ms", str(args.chat_latency_ms),
+        "--embed-latency-ms", str(args.embed_latency_ms),
+        "--jitter-ms", str(args.jitter_ms),
+        "--error-rate", str(args.error_rate),
+        "--dimensions", str(args.dimensions),
+        "--value", args.value
+    ]
+    if args.type_answer:
+        stub_args += ["--type-answer", args.type_answer]
+
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.stub_server", *stub_args], cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL)
+    try:
+        import httpx
+
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=10) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/stats")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("Stub server did not start")
+            yield client
+    finally:
+        process.terminate()
+        process.wait()
+
+async def timed_request(send) -> tuple[float, bool]:
+    started = time.perf_counter()
+    response = await send()
+    return time.perf_counter() - started, response.status_code == 200
+
+async def run_scenario(name: str, client, rng: random.Random, types: list[str], attributes: list[str], args: argparse.Namespace) -> tuple[int, list[tuple[float, bool]]]:
+    """
+    Returns the number of processed rows and the (latency, success) of every request.
+    """
+    if name == "normalize_text":
+        texts = synthetic_rows(rng, types, args.text_requests, args.duplicate_ratio)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def send_text(text: str):
+            async with semaphore:
+                return await timed_request(lambda: client.post("/processing/normalize_text", json=text))
+
+        return len(texts), await asyncio.gather(*[send_text(text) for text in texts])
+
+    results = []
+    for _ in range(args.repeat):
+        rows = synthetic_rows(rng, types, args.rows, args.duplicate_ratio)
+        if name == "normalize_xlsx":
+            sheet = build_xlsx([[row] for row in rows])
+        else:
+            expected = json.dumps({attribute: args.value for attribute in attributes}, ensure_ascii=False)
+            sheet = build_xlsx([[row, expected] for row in rows])
+        results.append(await timed_request(lambda: client.post(f"/processing/{name}", files={"file": ("sheet.xlsx", sheet)})))
+    return args.rows * args.repeat, results
+
+async def run_benchmarks(args: argparse.Namespace) -> list[dict]:
+    # Every run starts from an empty database, main also mounts the frontend directory relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="normalization-benchmark-")
+    os.symlink(os.path.join(REPOSITORY_ROOT, "frontend"), os.path.join(workdir, "frontend"))
+    os.chdir(workdir)
+
+    os.environ.update({
+        "LLM_BASE_URL": f"http://127.0.0.1:{args.port}/v1",
+        "EMBED_BASE_URL": f"http://127.0.0.1:{args.port}/v1",
+        "LLM_MODEL": "stub-chat",
+        "EMBED_MODEL": "stub-embedding",
+        "CHROMA_PATH": "",
+        "EMBED_CACHE_PATH": "",
+        "RESULT_CACHE_ENABLED": "true" if args.result_cache else "false",
+        "TRACE_SAMPLE_RATE": "0",
+        # Set explicitly, a DATABASE_URL from .env would otherwise point the run at a real database
+        "DATABASE_URL": f"sqlite:///{workdir}/database.db"
+    })
+
+    import httpx
+    import main
+
+    rng = random.Random(args.seed)
+    types = synthetic_types(args.types)
+    attributes = ATTRIBUTE_NAMES[:args.attributes]
+    seed_database(rng, types, attributes, args.examples_per_type, args.value)
+
+    reports = []
+    async with stub_backend(args) as stub, main.lifespan(main.app):
+        # Drop the requests made while indexing the seeded data
+        await stub.get("/stats", params={"reset": 1})
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for name in args.scenarios:
+                started = time.perf_counter()
+                rows, results = await run_scenario(name, client, rng, types, attributes, args)
+                elapsed = time.perf_counter() - started
+                latencies = [latency for latency, _ in results]
+                backend = (await stub.get("/stats", params={"reset": 1})).json()
+
+                reports.append({
+                    "scenario": name,
+                    "rows": rows,
+                    "requests": len(results),
+                    "failed_requests": sum(1 for _, ok in results if not ok),
+                    "seconds": round(elapsed, 3),
+                    "rows_per_second": round(rows / elapsed, 2) if elapsed else 0.0,
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "peak_rss_mb": round(peak_rss_mb(), 1),
+                    "backend": backend
+                })
+    return reports
+
+def print_reports(reports: list[dict]):
+    columns = ["scenario", "rows", "requests", "failed_requests", "seconds", "rows_per_second", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb"]
+    backend_columns = ["embedding_requests", "embedded_inputs", "chat_requests", "errors"]
+    table = [columns + backend_columns] + [
+        [str(report[column]) for column in columns] + [str(report["backend"][column]) for column in backend_columns]
+        for report in reports
+    ]
+    widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+    for row in table:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def build_parser() -> argparse.ArgumentParser:
+    # Backend options are shared with the stub server
+    parser = argparse.ArgumentParser(description="Offline benchmark of the processing endpoints", parents=[build_stub_parser()], add_help=False, conflict_handler="resolve")
+    parser.add_argument("-h", "--help", action="help")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--types", type=int, default=5, help="number of schemas")
+    parser.add_argument("--attributes", type=int, default=4, choices=range(1, len(ATTRIBUTE_NAMES) + 1), help="attributes per schema")
+    parser.add_argument("--examples-per-type", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=500, help="rows per generated sheet")
+    parser.add_argument("--repeat", type=int, default=3, help="sheets uploaded per bulk scenario")
+    parser.add_argument("--text-requests", type=int, default=200, help="requests of the normalize_text scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent normalize_text requests")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2, help="share of rows repeating an earlier row")
+    parser.add_argument("--result-cache", action="store_true", help="keep the LLM result cache enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json-output", help="also write the report to this file")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    if args.json_output:
+        args.json_output = os.path.abspath(args.json_output)
+    reports = asyncio.run(run_benchmarks(args))
+    print_reports(reports)
+    if args.json_output:
+        with open(args.json_output, "w", encoding="utf-8") as file:
+            json.dump(reports, file, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
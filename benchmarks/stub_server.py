@@ -0,0 +1,217 @@
+"""
+Stand-in for an OpenAI-compatible embedding and chat server, used by the benchmarks instead of Ollama.
+
+Answers are derived from the prompt: the type prompt gets the listed type that occurs in the text
+(or the first one), normalize prompts get every attribute of the template filled with a canned value.
+Run with `python -m benchmarks.stub_server --port 18080`, GET /stats returns request counters.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+ATTRIBUTE_LINE = re.compile(r'^\s*"(.+)": "\.\.\."')
+ITEM_LINE = re.compile(r'^\{"id": (\d+), "text": ')
+
+class StubState:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {
+                "embedding_requests": 0,
+                "embedded_inputs": 0,
+                "chat_requests": 0,
+                "chat_stream_requests": 0,
+                "errors": 0
+            }
+
+    def inc(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def delay(self, latency_ms: float):
+        jitter = random.uniform(-self.args.jitter_ms, self.args.jitter_ms)
+        time.sleep(max(0.0, latency_ms + jitter) / 1000)
+
+    def fails(self) -> bool:
+        return random.random() < self.args.error_rate
+
+def embed(text: str, dimensions: int) -> list[float]:
+    # Deterministic pseudo-random unit vector, the same text always gets the same embedding
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = sum(value * value for value in vector) ** 0.5
+    return [value / norm for value in vector]
+
+def prompt_section(prompt: str, header: str) -> list[str]:
+    """
+    Returns the non-empty lines that follow `header` up to the next blank line.
+    """
+    lines = prompt.splitlines()
+    if header not in lines:
+        return []
+    section = []
+    for line in lines[lines.index(header) + 1:]:
+        if not line.strip():
+            break
+        section.append(line.strip())
+    return section
+
+def answer_type(prompt: str, args: argparse.Namespace, schema: dict | None) -> str:
+    if args.type_answer:
+        answer = args.type_answer
+    else:
+        types = schema["properties"]["type"]["enum"][:-1] if schema else prompt_section(prompt, "Возможные типы:")
+        text = " ".join(prompt_section(prompt, "Текст:")).lower()
+        answer = next((type for type in types if type in text), types[0] if types else "неизвестно")
+    return json.dumps({"type": answer}, ensure_ascii=False) if schema else answer
+
+def answer_normalize(prompt: str, args: argparse.Namespace, schema: dict | None) -> str:
+    attributes = list(dict.fromkeys(match.group(1) for line in prompt.splitlines() if (match := ATTRIBUTE_LINE.match(line))))
+    values = {attribute: args.value for attribute in attributes}
+
+    if "Товары:" not in prompt:
+        return json.dumps(values, ensure_ascii=False)
+
+    items = [{"id": int(match.group(1)), "attributes": values} for line in prompt.splitlines() if (match := ITEM_LINE.match(line))]
+    return json.dumps({"items": items} if schema else items, ensure_ascii=False)
+
+def chat_answer(body: dict, args: argparse.Namespace) -> str:
+    prompt = body["messages"][-1]["content"]
+    schema = body.get("response_format", {}).get("json_schema", {}).get("schema")
+    if "определить тип" in prompt:
+        return answer_type(prompt, args, schema)
+    return answer_normalize(prompt, args, schema)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/stats":
+            self.send_json(404, {"error": "not found"})
+            return
+        counters = dict(self.state.counters)
+        if parse_qs(url.query).get("reset"):
+            self.state.reset()
+        self.send_json(200, counters)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = urlparse(self.path).path
+
+        if path.endswith("/embeddings"):
+            self.handle_embeddings(body)
+        elif path.endswith("/chat/completions"):
+            self.handle_chat(body)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def handle_embeddings(self, body: dict):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.state.inc("embedding_requests")
+        self.state.inc("embedded_inputs", len(inputs))
+        self.state.delay(self.state.args.embed_latency_ms)
+        if self.state.fails():
+            self.state.inc("errors")
+            self.send_json(500, {"error": {"message": "stub error"}})
+            return
+
+        self.send_json(200, {
+            "object": "list",
+            "model": body.get("model", "stub"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": embed(text, self.state.args.dimensions)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}
+        })
+
+    def handle_chat(self, body: dict):
+        self.state.inc("chat_requests")
+        self.state.delay(self.state.args.chat_latency_ms)
+        if self.state.fails():
+            self.state.inc("errors")
+            self.send_json(500, {"error": {"message": "stub error"}})
+            return
+
+        content = chat_answer(body, self.state.args)
+        base = {"id": "stub", "created": int(time.time()), "model": body.get("model", "stub")}
+
+        if not body.get("stream"):
+            self.send_json(200, {
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": len(body["messages"][-1]["content"]) // 4,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": (len(body["messages"][-1]["content"]) + len(content)) // 4
+                }
+            })
+            return
+
+        self.state.inc("chat_stream_requests")
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for start in range(0, len(content), 8):
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + 8]}, "finish_reason": None}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closes the stream once the JSON answer is complete
+            pass
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--chat-latency-ms", type=float, default=200.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with HTTP 500")
+    parser.add_argument("--dimensions", type=int, default=64, help="embedding size")
+    parser.add_argument("--type-answer", default="", help="answer every type prompt with this type")
+    parser.add_argument("--value", default="значение", help="value of every normalized attribute")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    StubHandler.state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"Stub server listening on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
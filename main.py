@@ -1,25 +1,59 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse
 from src.routers.examples import router as examples_router
 from src.routers.schemas import router as schemas_router
 from src.routers.processing import router as processing_router
+from src.routers.jobs import router as jobs_router, resume_jobs
+from src.routers.metrics import router as metrics_router
 from src.database.sqlite import Base, engine
 from src.database.chroma import init_client
+from src.database.outbox import start_worker, stop_worker
+from src.database.schema_registry import load_registry
+from src.ai.embedding_cache import embedding_cache
+from src.utils.tracing import trace_context
+from src.utils.formats import FormatError, FormatUnavailableError
+import uuid
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Create database tables at startup
     Base.metadata.create_all(bind=engine)
+    load_registry()
     await init_client()
+    # Continue batch jobs interrupted by the previous shutdown
+    resume_jobs()
+    # Apply changes of schemas and examples to the vector index in the background
+    start_worker()
     yield
+    await stop_worker()
+    # Embeddings queued for the disk cache are committed before exit
+    await embedding_cache.flush()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    # Trace records of the request carry its id, clients may pass their own
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    with trace_context(request_id=request_id):
+        response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.exception_handler(FormatError)
+async def format_error_handler(request: Request, exc: FormatError):
+    # A format that needs a missing optional package is a server limitation, not a bad request
+    status_code = 501 if isinstance(exc, FormatUnavailableError) else 400
+    return JSONResponse(status_code=status_code, content={"detail": str(exc)})
+
 # API routes must come BEFORE static file mounting
 app.include_router(examples_router)
 app.include_router(schemas_router)
 app.include_router(processing_router)
+app.include_router(jobs_router)
+app.include_router(metrics_router)
 
 # Mount static files AFTER registering API routes
 app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
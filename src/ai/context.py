@@ -0,0 +1,20 @@
+from dataclasses import dataclass, field
+from src.ai.embedding import embed_text
+
+@dataclass
+class ItemContext:
+    """
+    Per-item state carried through the pipeline, so type determination and
+    example retrieval share one query embedding instead of computing it twice.
+    A precomputed `embedding` may be passed in by the caller.
+    """
+    text: str
+    embedding: list[float] | None = None
+    types: list[str] = field(default_factory=list)
+    type_distances: list[float] = field(default_factory=list)
+    type: str | None = None
+
+    async def get_embedding(self) -> list[float]:
+        if self.embedding is None:
+            self.embedding = (await embed_text([self.text]))[0]
+        return self.embedding
@@ -1,4 +1,9 @@
 from openai import AsyncOpenAI
+from src.ai.embedding_cache import embedding_cache, cache_key
+from src.utils.batching import MicroBatcher
+from src.ai.scheduler import embedding_limiter
+from src.ai.recording import recorder
+from src.utils.metrics import timed, embedded_texts
 import os
 
 from dotenv import load_dotenv
@@ -9,11 +14,59 @@ client = AsyncOpenAI(
     api_key=os.getenv("EMBED_API_KEY", "OLLAMA")
 )
 
+def embedding_model() -> str:
+    return os.getenv("EMBED_MODEL", "nomic-embed-text:latest")
+
+async def embed_batch(texts: list[str]) -> list[list[float]]:
+    # Concurrent callers often ask for the same text within one batch window
+    unique_texts = list(dict.fromkeys(texts))
+    model = embedding_model()
+
+    # Texts are recorded one by one, batches are formed by timing and differ between runs
+    vectors = {}
+    for text in unique_texts:
+        vector = recorder.lookup("embedding", {"model": model, "input": text})
+        if vector is not None:
+            vectors[text] = vector
+    missing_texts = [text for text in unique_texts if text not in vectors]
+
+    if missing_texts:
+        async with embedding_limiter.slot():
+            response = await client.embeddings.create(
+                input=missing_texts,
+                model=model
+            )
+        embedded_texts.inc(len(missing_texts))
+
+        for text, embedding in zip(missing_texts, response.data):
+            vectors[text] = embedding.embedding
+            recorder.record("embedding", {"model": model, "input": text}, embedding.embedding)
+
+    return [vectors[text] for text in texts]
+
+# Single-text calls from concurrent coroutines are sent to the server as one request
+embedding_dispatcher = MicroBatcher(
+    embed_batch,
+    max_batch_size=int(os.getenv("EMBED_BATCH_MAX_SIZE", "64")),
+    max_wait=float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5")) / 1000
+)
+
 async def embed_text(text: list[str]) -> list[list[float]]:
-    response = await client.embeddings.create(
-        input=text,
-        model=os.getenv("EMBED_MODEL", "nomic-embed-text:latest")
-    )
+    model = embedding_model()
+    keys = [cache_key(model, item) for item in text]
+
+    vectors = await embedding_cache.get_many(keys)
+    missing = {}
+    for key, item in zip(keys, text):
+        if key not in vectors and key not in missing:
+            missing[key] = item
 
-    return [embedding.embedding for embedding in response.data]
+    if missing:
+        # Timed here rather than in embed_batch, which runs in a task of its own and would credit only one of the batched requests
+        with timed("embedding"):
+            embeddings = await embedding_dispatcher.submit(list(missing.values()))
+        computed = dict(zip(missing.keys(), embeddings))
+        embedding_cache.put_many(computed)
+        vectors.update(computed)
 
+    return [vectors[key] for key in keys]
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def cache_key(model: str, text: str) -> str:
+    """
+    Content address of an embedding: the model name plus the text with collapsed whitespace.
+    """
+    normalized_text = " ".join(text.split())
+    return hashlib.sha256(f"{model}\0{normalized_text}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-memory LRU in front of an optional SQLite file.
+    The file is read and written on a thread of its own. Writes are queued and committed in groups:
+    while one commit runs, vectors put by other calls wait for the next one.
+    """
+
+    def __init__(self, max_size: int, path: str | None = None):
+        self.max_size = max_size
+        self.memory: OrderedDict[str, list[float]] = OrderedDict()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.connection = None
+        # Vectors waiting for the next commit, also served to lookups until they are on disk
+        self.pending_writes: dict[str, list[float]] = {}
+        self.writer: asyncio.Task | None = None
+        if path:
+            # One thread owns the connection, so reads and commits never run on the event loop or at the same time
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache")
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            # A commit per write group, NORMAL sync is safe with WAL and avoids an fsync per commit
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self.connection.commit()
+
+    async def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """
+        Returns the cached vectors of `keys`, keys missing from both tiers are left out.
+        """
+        found = {}
+        disk_keys = []
+        for key in dict.fromkeys(keys):
+            vector = self.memory.get(key)
+            if vector is None:
+                vector = self.pending_writes.get(key)
+            if vector is not None:
+                self.memory[key] = vector
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                found[key] = vector
+            else:
+                disk_keys.append(key)
+
+        if self.connection is not None and disk_keys:
+            loop = asyncio.get_running_loop()
+            for key, vector in (await loop.run_in_executor(self.executor, self._read, disk_keys)).items():
+                self._remember(key, vector)
+                self.counters["disk_hits"] += 1
+                found[key] = vector
+
+        self.counters["misses"] += sum(1 for key in disk_keys if key not in found)
+        return found
+
+    def put_many(self, items: dict[str, list[float]]):
+        for key, vector in items.items():
+            self._remember(key, vector)
+
+        if self.connection is not None and items:
+            self.pending_writes.update(items)
+            if self.writer is None or self.writer.done():
+                self.writer = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def flush(self):
+        """
+        Waits until every queued vector is committed, called at shutdown.
+        """
+        if self.writer is not None:
+            await self.writer
+
+    async def _write_pending(self):
+        loop = asyncio.get_running_loop()
+        while self.pending_writes:
+            items = self.pending_writes
+            self.pending_writes = {}
+            try:
+                await loop.run_in_executor(self.executor, self._write, items)
+            except Exception:
+                # The disk tier is only a cache, the vectors stay in memory and are computed again after a restart
+                logger.exception(f"Could not store {len(items)} embeddings in the disk cache")
+
+    def _read(self, keys: list[str]) -> dict[str, list[float]]:
+        vectors = {}
+        # Stays below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})",
+                batch
+            ).fetchall()
+            vectors.update({key: array("d", vector).tolist() for key, vector in rows})
+        return vectors
+
+    def _write(self, items: dict[str, list[float]]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(key, array("d", vector).tobytes()) for key, vector in items.items()]
+        )
+        self.connection.commit()
+
+    def stats(self) -> dict:
+        lookups = sum(self.counters.values())
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        return {
+            **self.counters,
+            "size": len(self.memory),
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0
+        }
+
+    def _remember(self, key: str, vector: list[float]):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+embedding_cache = EmbeddingCache(
+    max_size=int(os.getenv("EMBED_CACHE_SIZE", "10000")),
+    path=os.getenv("EMBED_CACHE_PATH")
+)
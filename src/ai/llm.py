@@ -1,6 +1,15 @@
 from openai import AsyncOpenAI
 import os
-from src.database.chroma import get_types, get_examples
+from src.database.chroma import get_scored_types, get_nearest_example, get_examples
+from src.ai.context import ItemContext
+from src.ai.scheduler import llm_limiter, map_bounded
+from src.ai.recording import recorder
+from src.utils.metrics import timed, llm_tokens, json_parse_failures
+from src.utils.tracing import trace, sampled
+from src.database.schema_registry import SchemaEntry
+from src.database.result_cache import get_cached, put_cached, type_cache_key, normalize_cache_key, examples_scope
+from collections import defaultdict
+import hashlib
 import json
 from dotenv import load_dotenv
 import logging
@@ -41,37 +50,195 @@ normalize_prompt = """
 ```
 """
 
+batch_normalize_prompt = """
+/no_think
+Ты должен нормализовать каждый из заданных товаров в json формат.
+Ключи - названия атрибутов, значения - значения атрибутов.
+Если атрибут неизвестен, напиши "Неизвестно".
+
+Товары:
+{items}
+
+Ответ должен быть JSON массивом с объектом для каждого товара в заданном формате:
+```json
+[
+{{"id": <id товара>, "attributes": {attributes_examples}}}
+]
+```
+"""
+
+# Prefix layout: static instructions, candidate types or attribute template and examples come first
+# and the item text last, so servers with prefix caching reuse the prefill between items
+type_prompt_prefix = """
+/no_think
+Ты должен определить тип товара по заданному тексту.
+Ответ должен быть либо одним из заданных типов, либо "неизвестно".
+Выведи в ответе только тип, без дополнительных комментариев или лишнего текста.
+
+Возможные типы:
+{types}
+
+Текст:
+{unnormalized_text}
+
+Тип: 
+"""
+
+normalize_prompt_prefix = """
+/no_think
+Ты должен нормализовать заданный товар в json формат.
+Ключи - названия атрибутов, значения - значения атрибутов.
+Если атрибут неизвестен, напиши "Неизвестно".
+
+Ответ должен быть заданном формате:
+```json
+{attributes_examples}
+```
+{examples}
+
+Текст:
+{unnormalized_text}
+"""
+
+batch_normalize_prompt_prefix = """
+/no_think
+Ты должен нормализовать каждый из заданных товаров в json формат.
+Ключи - названия атрибутов, значения - значения атрибутов.
+Если атрибут неизвестен, напиши "Неизвестно".
+
+Ответ должен быть JSON массивом с объектом для каждого товара в заданном формате:
+```json
+[
+{{"id": <id товара>, "attributes": {attributes_examples}}}
+]
+```
+{examples}
+
+Товары:
+{items}
+"""
+
+# "default" or "prefix"
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "default")
+
+# Cached results are tied to the prompts that produced them
+prompts_fingerprint = hashlib.sha256((
+    type_prompt + normalize_prompt + batch_normalize_prompt
+    + type_prompt_prefix + normalize_prompt_prefix + batch_normalize_prompt_prefix
+    + PROMPT_LAYOUT
+).encode("utf-8")).hexdigest()[:16]
+
+# Number of same-type items packed into one normalization prompt, 1 sends every item separately
+NORMALIZE_BATCH_SIZE = int(os.getenv("NORMALIZE_BATCH_SIZE", "1"))
+# Few-shot examples shared by a batch prompt
+NORMALIZE_BATCH_MAX_EXAMPLES = int(os.getenv("NORMALIZE_BATCH_MAX_EXAMPLES", "5"))
+
+def optional_float(name: str) -> float | None:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+def optional_int(name: str) -> int | None:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+# Constrain answers with the OpenAI-compatible response_format JSON schema built from the schema attributes
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "false").lower() == "true"
+# Token caps. The normalization cap defaults to a budget per attribute (and per item in batch prompts)
+LLM_TYPE_MAX_TOKENS = int(os.getenv("LLM_TYPE_MAX_TOKENS", "64"))
+LLM_NORMALIZE_MAX_TOKENS = optional_int("LLM_NORMALIZE_MAX_TOKENS")
+LLM_NORMALIZE_TOKENS_PER_ATTRIBUTE = int(os.getenv("LLM_NORMALIZE_TOKENS_PER_ATTRIBUTE", "64"))
+# Stop sequences as JSON lists, e.g. LLM_NORMALIZE_STOP='["\\n\\n\\n"]'
+LLM_TYPE_STOP = json.loads(os.getenv("LLM_TYPE_STOP", "null"))
+LLM_NORMALIZE_STOP = json.loads(os.getenv("LLM_NORMALIZE_STOP", "null"))
+# Stream normalization answers and stop reading as soon as the top-level JSON value is closed
+LLM_STREAM_EARLY_STOP = os.getenv("LLM_STREAM_EARLY_STOP", "false").lower() == "true"
+
+# Fast path thresholds on Chroma distances (lower is closer), unset values disable the check.
+# The nearest schema is taken without asking the LLM when it is within TYPE_FAST_PATH_MAX_DISTANCE
+# and at least TYPE_FAST_PATH_MIN_MARGIN closer than the runner-up.
+TYPE_FAST_PATH_MAX_DISTANCE = optional_float("TYPE_FAST_PATH_MAX_DISTANCE")
+TYPE_FAST_PATH_MIN_MARGIN = optional_float("TYPE_FAST_PATH_MIN_MARGIN") or 0.0
+# The type of the nearest example is taken when it is within EXAMPLE_FAST_PATH_MAX_DISTANCE
+EXAMPLE_FAST_PATH_MAX_DISTANCE = optional_float("EXAMPLE_FAST_PATH_MAX_DISTANCE")
+# Part of the type cache key, a cached type is only reused under the thresholds that produced it
+fast_path_thresholds = (TYPE_FAST_PATH_MAX_DISTANCE, TYPE_FAST_PATH_MIN_MARGIN, EXAMPLE_FAST_PATH_MAX_DISTANCE)
+
+# How determine_type decided the type of each item
+type_path_counters = {"cache": 0, "schema_match": 0, "example_match": 0, "llm": 0}
+
 client = AsyncOpenAI(
     api_key=os.getenv("API_KEY", "Ollama"),
     base_url=os.getenv("LLM_BASE_URL", "http://localhost:11434/v1")
 )
 
-async def determine_type(unnormalized_text: str) -> str:
-    types = await get_types(unnormalized_text)
+async def determine_type_from_scores(unnormalized_text: str, context: ItemContext) -> tuple[str | None, str | None]:
+    """
+    Decides the type from retrieval distances alone when the match is unambiguous.
+    Returns the type and the path that decided it ("schema_match" or "example_match"), or (None, None).
+    """
+    if TYPE_FAST_PATH_MAX_DISTANCE is not None and context.types:
+        best_distance = context.type_distances[0]
+        margin = context.type_distances[1] - best_distance if len(context.type_distances) > 1 else float("inf")
+        if best_distance <= TYPE_FAST_PATH_MAX_DISTANCE and margin >= TYPE_FAST_PATH_MIN_MARGIN:
+            type_path_counters["schema_match"] += 1
+            return context.types[0], "schema_match"
 
-    examples_type_prompt = type_prompt.format(
-        unnormalized_text=unnormalized_text,
-        types="\n".join(types)
-    )
+    if EXAMPLE_FAST_PATH_MAX_DISTANCE is not None:
+        nearest = await get_nearest_example(unnormalized_text, await context.get_embedding())
+        if nearest is not None and nearest[1] <= EXAMPLE_FAST_PATH_MAX_DISTANCE:
+            type_path_counters["example_match"] += 1
+            return nearest[0], "example_match"
+
+    return None, None
 
-    response = await client.chat.completions.create(
-        model=os.getenv("LLM_MODEL"),
-        messages=[{"role": "user", "content": examples_type_prompt}],
-        temperature=0.0
+async def determine_type(unnormalized_text: str, context: ItemContext | None = None) -> str:
+    context = context or ItemContext(unnormalized_text)
+
+    cache_key, cached_type = await get_cached(
+        type_cache_key(unnormalized_text, os.getenv("LLM_MODEL"), prompts_fingerprint, fast_path_thresholds),
+        "schemas"
     )
+    if cached_type is not None:
+        type_path_counters["cache"] += 1
+        context.type = cached_type
+        return cached_type
 
-    logger.info(f"\n\n" + "-" * 100 + f"\nDETERMINE TYPE PROMPT: \n{examples_type_prompt}\n\n ANSWER: \n{response.choices[0].message.content}\n" + "-" * 100 + "\n\n")
+    scored_types = await get_scored_types(unnormalized_text, await context.get_embedding())
+    types = [type for type, _ in scored_types]
+    context.types = types
+    context.type_distances = [distance for _, distance in scored_types]
 
-    return response.choices[0].message.content.replace("<think>", "").replace("</think>", "").strip().lower()
+    fast_type, fast_path = await determine_type_from_scores(unnormalized_text, context)
+    if fast_type is not None:
+        context.type = fast_type
+        # A type taken from the nearest example depends on the examples, which the "schemas" scope does not track.
+        # The fast path is cheap, so only schema matches are cached
+        if fast_path == "schema_match":
+            await put_cached(cache_key, "type", "schemas", context.type)
+        return context.type
 
-async def normalize_text(unnormalized_text: str, type: str, attributes: list[str]) -> dict:
-    unnormalized_texts, normalized_jsons = await get_examples(unnormalized_text, type)
+    type_path_counters["llm"] += 1
 
-    attributes_examples = "{\n" + "\n".join([f"    \"{attribute}\": \"...\"" + ("," if i < len(attributes) - 1 else "") for i, attribute in enumerate(attributes)]) + "\n}"
+    examples_type_prompt = build_type_prompt(unnormalized_text, types)
 
-    # Process and clean up normalized_jsons examples
+    content = await complete(
+        "type",
+        examples_type_prompt,
+        max_tokens=LLM_TYPE_MAX_TOKENS,
+        stop=LLM_TYPE_STOP,
+        json_schema=type_json_schema(types) if LLM_STRUCTURED_OUTPUT else None
+    )
+
+    context.type = parse_type(content)
+    await put_cached(cache_key, "type", "schemas", context.type)
+
+    return context.type
+
+def clean_example_jsons(normalized_jsons: list, schema: SchemaEntry) -> list[str]:
+    """
+    Aligns example JSONs with the schema: drops unknown keys and fills missing attributes.
+    """
     processed_jsons = []
-    attributes_lower = [attr.lower().strip() for attr in attributes]
     
     for normalized_json_str in normalized_jsons:
         if not isinstance(normalized_json_str, dict):
@@ -80,32 +247,151 @@ async def normalize_text(unnormalized_text: str, type: str, attributes: list[str
             normalized_json = normalized_json_str
           
         # Remove keys not in attributes list (case insensitive)
-        keys_to_remove = [key for key in normalized_json if key.lower().strip() not in attributes_lower]
+        keys_to_remove = [key for key in normalized_json if key.lower().strip() not in schema.attribute_set]
         for key in keys_to_remove:
             del normalized_json[key]
           
         # Add missing attributes with empty string values
-        for i, attr in enumerate(attributes):
-            attr_lower = attributes_lower[i]
-            if not any(key.lower().strip() == attr_lower for key in normalized_json):
+        present = {key.lower().strip() for key in normalized_json}
+        for attr, attr_lower in zip(schema.attributes, schema.attributes_lower):
+            if attr_lower not in present:
                 normalized_json[attr] = "Неизвестно"
                   
         processed_jsons.append(json.dumps(normalized_json, ensure_ascii=False))
-    
-    examples_normalize_prompt = normalize_prompt.format(
-        unnormalized_text=unnormalized_text,
-        attributes_examples=attributes_examples
-    ) + "\n\nПримеры нормализации:\n" + "\n\n".join([f"Текст: {unnormalized_text}\nНормализованный товар: {processed_json}" for unnormalized_text, processed_json in zip(unnormalized_texts, processed_jsons)])
 
-    response = await client.chat.completions.create(
-        model=os.getenv("LLM_MODEL"),
-        messages=[{"role": "user", "content": examples_normalize_prompt}],
-        temperature=0.0
-    )
+    return processed_jsons
+
+def examples_section(unnormalized_texts: list[str], processed_jsons: list[str]) -> str:
+    return "\n\nПримеры нормализации:\n" + "\n\n".join([f"Текст: {unnormalized_text}\nНормализованный товар: {processed_json}" for unnormalized_text, processed_json in zip(unnormalized_texts, processed_jsons)])
+
+def type_json_schema(types: list[str]) -> dict:
+    return {
+        "type": "object",
+        "properties": {"type": {"type": "string", "enum": list(types) + ["неизвестно"]}},
+        "required": ["type"],
+        "additionalProperties": False
+    }
+
+def normalize_max_tokens(attributes: list[str], items: int) -> int:
+    if LLM_NORMALIZE_MAX_TOKENS is not None:
+        return LLM_NORMALIZE_MAX_TOKENS * items
+    # Room for the think tags and code fences plus a budget per value
+    return 64 + LLM_NORMALIZE_TOKENS_PER_ATTRIBUTE * len(attributes) * items
+
+def json_end(content: str) -> int | None:
+    """
+    Returns the index right after the first complete top-level JSON object or array in `content`.
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, char in enumerate(content):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"' and depth > 0:
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+async def complete(name: str, prompt: str, max_tokens: int, stop: list[str] | None = None, json_schema: dict | None = None, stream_json: bool = False) -> str:
+    """
+    Runs a chat completion under the LLM concurrency limit and returns the answer text.
+    `name` labels the call in metrics.
+    With `stream_json` the answer is streamed and the stream is closed once the first JSON value is complete.
+    """
+    params = {
+        "model": os.getenv("LLM_MODEL"),
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.0,
+        "max_tokens": max_tokens
+    }
+    if stop:
+        params["stop"] = stop
+    if json_schema is not None:
+        params["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "answer", "schema": json_schema, "strict": True}
+        }
+
+    # Streaming only changes how the answer is read, replayed calls are matched without it
+    recorded = recorder.lookup("chat", params)
+    if recorded is not None:
+        return recorded
+
+    async with llm_limiter.slot():
+        if not stream_json:
+            with timed("llm", call=name):
+                response = await client.chat.completions.create(**params)
+            if response.usage is not None:
+                llm_tokens.observe(response.usage.prompt_tokens, call=name, kind="prompt")
+                llm_tokens.observe(response.usage.completion_tokens, call=name, kind="completion")
+            content = response.choices[0].message.content or ""
+        else:
+            with timed("llm", call=name):
+                content = await read_json_stream(await client.chat.completions.create(**params, stream=True))
+
+    # Full prompts are kilobytes long, only a sample of calls is written to the trace
+    if sampled():
+        trace("llm_call", call=name, model=params["model"], prompt=prompt, answer=content)
+
+    recorder.record("chat", params, content)
+
+    return content
+
+async def read_json_stream(stream) -> str:
+    """
+    Reads a streamed answer until the first JSON value is complete, then closes the stream.
+    """
+    content = ""
+    try:
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            content += chunk.choices[0].delta.content
+
+            # Braces inside an unfinished think block are not part of the answer
+            if "<think>" in content and "</think>" not in content:
+                continue
+            think, separator, answer = content.rpartition("</think>")
+            end = json_end(answer)
+            if end is not None:
+                return think + separator + answer[:end]
+    finally:
+        await stream.close()
+
+    return content
+
+def parse_type(content: str) -> str:
+    content = content.replace("<think>", "").replace("</think>", "").strip()
+    if content.startswith("{"):
+        try:
+            return str(json.loads(content)["type"]).strip().lower()
+        except (json.JSONDecodeError, KeyError, TypeError):
+            pass
+    return content.lower()
 
-    logger.info(f"\n\n" + "-" * 100 + f"\nNORMALIZE TEXT PROMPT: \n{examples_normalize_prompt}\n\n ANSWER: \n{response.choices[0].message.content}\n" + "-" * 100 + "\n\n")
+def parse_json(content: str):
+    """
+    Parses the answer as JSON, falling back to cutting it out of a code block.
+    """
+    stripped = content.replace("<think>", "").replace("</think>", "").strip()
+    try:
+        return json.loads(stripped)
+    except json.JSONDecodeError:
+        return json.loads(extract_json(content))
 
-    content = response.choices[0].message.content.strip()
+def extract_json(content: str) -> str:
+    content = content.strip()
 
     # Find and remove code block markers using indexes
     start_marker = "```json"
@@ -119,10 +405,197 @@ async def normalize_text(unnormalized_text: str, type: str, attributes: list[str
     if end_idx != -1:
         content = content[:end_idx].strip()
 
-    content = content.replace("'", '"')
+    return content.replace("'", '"')
+
+def build_type_prompt(unnormalized_text: str, types: list[str]) -> str:
+    if PROMPT_LAYOUT == "prefix":
+        # A stable order lets items with the same candidates share the whole prefix
+        return type_prompt_prefix.format(
+            types="\n".join(sorted(types)),
+            unnormalized_text=unnormalized_text
+        )
+
+    return type_prompt.format(
+        unnormalized_text=unnormalized_text,
+        types="\n".join(types)
+    )
+
+def build_normalize_prompt(unnormalized_text: str, schema: SchemaEntry, examples: str) -> str:
+    if PROMPT_LAYOUT == "prefix":
+        return normalize_prompt_prefix.format(
+            attributes_examples=schema.template,
+            examples=examples,
+            unnormalized_text=unnormalized_text
+        )
+
+    return normalize_prompt.format(
+        unnormalized_text=unnormalized_text,
+        attributes_examples=schema.template
+    ) + examples
+
+def build_batch_normalize_prompt(items: str, schema: SchemaEntry, examples: str) -> str:
+    if PROMPT_LAYOUT == "prefix":
+        return batch_normalize_prompt_prefix.format(
+            attributes_examples=schema.template,
+            examples=examples,
+            items=items
+        )
+
+    return batch_normalize_prompt.format(
+        items=items,
+        attributes_examples=schema.template
+    ) + examples
+
+async def normalize_text(unnormalized_text: str, schema: SchemaEntry, context: ItemContext | None = None) -> dict:
+    context = context or ItemContext(unnormalized_text)
+    type = schema.type
+
+    cache_key, cached_result = await get_cached(
+        normalize_cache_key(unnormalized_text, type, schema.attributes, os.getenv("LLM_MODEL"), prompts_fingerprint),
+        examples_scope(type)
+    )
+    if cached_result is not None:
+        return cached_result
+
+    unnormalized_texts, normalized_jsons = await get_examples(unnormalized_text, type, await context.get_embedding())
+
+    # Process and clean up normalized_jsons examples
+    processed_jsons = clean_example_jsons(normalized_jsons, schema)
+    
+    examples_normalize_prompt = build_normalize_prompt(unnormalized_text, schema, examples_section(unnormalized_texts, processed_jsons))
+
+    content = await complete(
+        "normalize",
+        examples_normalize_prompt,
+        max_tokens=normalize_max_tokens(schema.attributes, 1),
+        stop=LLM_NORMALIZE_STOP,
+        json_schema=schema.json_schema if LLM_STRUCTURED_OUTPUT else None,
+        stream_json=LLM_STREAM_EARLY_STOP
+    )
 
     try:
-        return json.loads(content)
-    except:
-        print(f"Error parsing JSON: {content}")
+        result = parse_json(content)
+    except json.JSONDecodeError:
+        result = None
+
+    if not isinstance(result, dict):
+        json_parse_failures.inc(call="normalize")
+        logger.warning("Error parsing JSON answer of normalize call")
+        trace("json_parse_failure", call="normalize", prompt=examples_normalize_prompt, answer=content)
         return {}
+
+    await put_cached(cache_key, "normalize", examples_scope(type), result)
+
+    return result
+
+async def normalize_texts(unnormalized_texts: list[str], schema: SchemaEntry, contexts: list[ItemContext] | None = None) -> list[dict]:
+    """
+    Normalizes several items of one type with a single chat completion.
+    Items missing from the answer or with unparseable output are retried in smaller batches,
+    down to normalize_text for a single item.
+    """
+    contexts = contexts or [ItemContext(text) for text in unnormalized_texts]
+    type = schema.type
+    if len(unnormalized_texts) == 1:
+        return [await normalize_text(unnormalized_texts[0], schema, contexts[0])]
+
+    results: list[dict | None] = [None] * len(unnormalized_texts)
+    cache_keys: list[str] = [""] * len(unnormalized_texts)
+    pending = []
+    for i, text in enumerate(unnormalized_texts):
+        cache_keys[i], results[i] = await get_cached(
+            normalize_cache_key(text, type, schema.attributes, os.getenv("LLM_MODEL"), prompts_fingerprint),
+            examples_scope(type)
+        )
+        if results[i] is None:
+            pending.append(i)
+
+    if not pending:
+        return results
+
+    if len(pending) == 1:
+        i = pending[0]
+        results[i] = await normalize_text(unnormalized_texts[i], schema, contexts[i])
+        return results
+
+    # Few-shot examples of all items in the batch, closest to each item first, without repeats
+    example_texts, example_jsons = [], []
+    for i in pending:
+        texts, jsons = await get_examples(unnormalized_texts[i], type, await contexts[i].get_embedding())
+        for text, normalized_json in zip(texts, jsons):
+            if text not in example_texts and len(example_texts) < NORMALIZE_BATCH_MAX_EXAMPLES:
+                example_texts.append(text)
+                example_jsons.append(normalized_json)
+
+    items = "\n".join(json.dumps({"id": item_id, "text": unnormalized_texts[i]}, ensure_ascii=False) for item_id, i in enumerate(pending))
+
+    examples_normalize_prompt = build_batch_normalize_prompt(items, schema, examples_section(example_texts, clean_example_jsons(example_jsons, schema)))
+
+    content = await complete(
+        "batch_normalize",
+        examples_normalize_prompt,
+        max_tokens=normalize_max_tokens(schema.attributes, len(pending)),
+        stop=LLM_NORMALIZE_STOP,
+        json_schema=schema.batch_json_schema if LLM_STRUCTURED_OUTPUT else None,
+        stream_json=LLM_STREAM_EARLY_STOP
+    )
+
+    answers = {}
+    try:
+        parsed = parse_json(content)
+        # Structured output wraps the array into an object, JSON schemas must have an object at the top
+        if isinstance(parsed, dict):
+            parsed = parsed.get("items", [])
+        for answer in parsed:
+            if isinstance(answer, dict) and isinstance(answer.get("attributes"), dict):
+                answers[answer.get("id")] = answer["attributes"]
+    except (json.JSONDecodeError, TypeError):
+        json_parse_failures.inc(call="batch_normalize")
+        logger.warning("Error parsing JSON answer of batch_normalize call")
+        trace("json_parse_failure", call="batch_normalize", prompt=examples_normalize_prompt, answer=content)
+
+    failed = []
+    for item_id, i in enumerate(pending):
+        if item_id in answers:
+            results[i] = answers[item_id]
+            await put_cached(cache_keys[i], "normalize", examples_scope(type), results[i])
+        else:
+            failed.append(i)
+
+    # Split the items the model did not answer and try again
+    if failed:
+        middle = (len(failed) + 1) // 2
+        for half in [failed[:middle], failed[middle:]]:
+            if half:
+                retried = await normalize_texts([unnormalized_texts[i] for i in half], schema, [contexts[i] for i in half])
+                for i, result in zip(half, retried):
+                    results[i] = result
+
+    return results
+
+async def normalize_many(tasks: list[tuple[str, SchemaEntry, ItemContext]]) -> list[dict]:
+    """
+    Normalizes (text, schema, context) tasks. With NORMALIZE_BATCH_SIZE > 1 items of the same type
+    are packed into shared prompts, otherwise every item gets its own.
+    """
+    # Items of one type are dispatched back-to-back so their shared prompt prefix stays in the server's cache
+    type_to_indices = defaultdict(list)
+    for i, (_, schema, _) in enumerate(tasks):
+        type_to_indices[schema.type].append(i)
+
+    batch_size = max(1, NORMALIZE_BATCH_SIZE)
+    batches = []
+    for indices in type_to_indices.values():
+        for start in range(0, len(indices), batch_size):
+            batches.append(indices[start:start + batch_size])
+
+    async def run_batch(batch: list[int]) -> list[dict]:
+        schema = tasks[batch[0]][1]
+        return await normalize_texts([tasks[i][0] for i in batch], schema, [tasks[i][2] for i in batch])
+
+    results: list[dict] = [{}] * len(tasks)
+    for batch, batch_results in zip(batches, await map_bounded(run_batch, batches)):
+        for i, result in zip(batch, batch_results):
+            results[i] = result
+
+    return results
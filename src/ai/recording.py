@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+RECORDING_MODES = ("off", "record", "replay", "replay_or_record")
+
+class ReplayMissError(RuntimeError):
+    pass
+
+def request_key(kind: str, request: dict) -> str:
+    return hashlib.sha256(f"{kind}\0{json.dumps(request, ensure_ascii=False, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+class Recorder:
+    """
+    Stores backend responses by request in a JSON lines file and serves them back.
+
+    - record: every call goes to the backend and its response is written to the file
+    - replay: responses are served from the file, a missing request raises ReplayMissError
+    - replay_or_record: responses are served from the file, missing requests go to the backend and are recorded
+    """
+
+    def __init__(self, mode: str, path: str):
+        if mode not in RECORDING_MODES:
+            raise ValueError(f"Unknown recording mode {mode!r}, expected one of {', '.join(RECORDING_MODES)}")
+        self.mode = mode
+        self.path = path
+        self.responses: dict[str, object] = {}
+        self.counters = {"hits": 0, "misses": 0, "recorded": 0}
+        self.file = None
+
+        if mode in ("replay", "replay_or_record") and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.responses[entry["key"]] = entry["response"]
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode in ("replay", "replay_or_record")
+
+    def lookup(self, kind: str, request: dict):
+        """
+        Returns the recorded response, or None when the request has to be sent to the backend.
+        """
+        if not self.replaying:
+            return None
+
+        key = request_key(kind, request)
+        if key in self.responses:
+            self.counters["hits"] += 1
+            return self.responses[key]
+
+        self.counters["misses"] += 1
+        if self.mode == "replay":
+            raise ReplayMissError(f"No recorded {kind} response for this request in {self.path}")
+        return None
+
+    def record(self, kind: str, request: dict, response):
+        if self.mode not in ("record", "replay_or_record"):
+            return
+
+        key = request_key(kind, request)
+        self.responses[key] = response
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(json.dumps({"key": key, "kind": kind, "request": request, "response": response}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.counters["recorded"] += 1
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "size": len(self.responses), **self.counters}
+
+recorder = Recorder(
+    mode=os.getenv("RECORDING_MODE", "off").lower(),
+    path=os.getenv("RECORDING_PATH", "recordings.jsonl")
+)
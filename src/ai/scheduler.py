@@ -0,0 +1,148 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+import time
+from typing import Awaitable, Callable, Iterable, TypeVar
+
+from dotenv import load_dotenv
+load_dotenv()
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+class ConcurrencyLimiter:
+    """
+    Caps the number of in-flight calls to a backend.
+    In adaptive mode the cap follows AIMD: it grows by about one slot per round of calls
+    that finish under `target_latency` and is multiplied by `decrease_factor` when a call is slower or fails.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        adaptive: bool = False,
+        min_limit: int = 1,
+        max_limit: int | None = None,
+        target_latency: float = 10.0,
+        decrease_factor: float = 0.7
+    ):
+        self.name = name
+        self.limit = float(limit)
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit * 4
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            self.waiting += 1
+            try:
+                await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+        started = time.monotonic()
+        failed = False
+        cancelled = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        except BaseException:
+            # A cancelled caller (client disconnect, failed sibling) says nothing about the backend
+            cancelled = True
+            raise
+        finally:
+            latency = time.monotonic() - started
+            async with self.condition:
+                self.in_flight -= 1
+                if not cancelled:
+                    self.completed += 1
+                    if failed:
+                        self.failed += 1
+                    if self.adaptive:
+                        self._adjust(latency, failed)
+                self.condition.notify_all()
+
+    def _adjust(self, latency: float, failed: bool):
+        now = time.monotonic()
+        if failed or latency > self.target_latency:
+            # Calls that were already in flight report the same overload, decrease once per latency window
+            if now - self.last_decrease > self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+def limiter_from_env(name: str, prefix: str, default_limit: int, default_target_latency_ms: int) -> ConcurrencyLimiter:
+    return ConcurrencyLimiter(
+        name,
+        limit=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(default_limit))),
+        adaptive=os.getenv(f"{prefix}_ADAPTIVE_CONCURRENCY", "false").lower() == "true",
+        max_limit=int(os.getenv(f"{prefix}_MAX_ADAPTIVE_CONCURRENCY", "0")) or None,
+        target_latency=float(os.getenv(f"{prefix}_TARGET_LATENCY_MS", str(default_target_latency_ms))) / 1000
+    )
+
+llm_limiter = limiter_from_env("llm", "LLM", default_limit=16, default_target_latency_ms=30000)
+embedding_limiter = limiter_from_env("embedding", "EMBED", default_limit=4, default_target_latency_ms=2000)
+
+# Number of items a batch endpoint keeps in progress at once
+PIPELINE_MAX_IN_FLIGHT = int(os.getenv("PIPELINE_MAX_IN_FLIGHT", "64"))
+# Streamed uploads are processed in chunks of this many rows while the rest of the file is parsed
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "512"))
+# Chunks being processed at once, the parser waits when this many are in progress
+INGEST_MAX_CHUNKS_IN_FLIGHT = int(os.getenv("INGEST_MAX_CHUNKS_IN_FLIGHT", "2"))
+
+async def map_bounded(func: Callable[[T], Awaitable[R]], items: Iterable[T], limit: int = PIPELINE_MAX_IN_FLIGHT) -> list[R]:
+    """
+    Like asyncio.gather(*map(func, items)), but only `limit` coroutines exist at a time.
+    Items are started in order, results are returned in input order.
+    The first exception stops the remaining items: the other workers are cancelled and awaited before it is raised.
+    """
+    items = list(items)
+    results: list = [None] * len(items)
+    next_index = 0
+    if not items:
+        return results
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(items):
+            index = next_index
+            next_index += 1
+            results[index] = await func(items[index])
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(limit, len(items)))]
+    try:
+        await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # Also reached when the caller is cancelled, no worker may outlive the call
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    for task in workers:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return results
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from typing import Callable
+from src.database.sqlite import get_session, run_db
+from src.database.result_cache import bump_version
+from src.database.chroma import add_rows_chroma, delete_rows_chroma
+import logging
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Rows inserted into SQLite per flush during uploads
+INGEST_DB_BATCH_SIZE = int(os.getenv("INGEST_DB_BATCH_SIZE", "1000"))
+
+# Progress of the latest uploads by id, polled while a long upload runs
+MAX_TRACKED_UPLOADS = 100
+uploads: OrderedDict[str, dict] = OrderedDict()
+
+def start_upload(upload_id: str, kind: str, total: int) -> dict:
+    progress = {
+        "id": upload_id,
+        "kind": kind,
+        "status": "running",
+        "total": total,
+        "skipped": 0,
+        "stored": 0,
+        "indexed": 0,
+        "error": None
+    }
+    uploads[upload_id] = progress
+    uploads.move_to_end(upload_id)
+    while len(uploads) > MAX_TRACKED_UPLOADS:
+        uploads.popitem(last=False)
+    return progress
+
+def index_progress(progress: dict) -> Callable[[int], None]:
+    def on_progress(count: int):
+        progress["indexed"] += count
+    return on_progress
+
+def insert_rows(rows: list, respond: Callable, document: Callable, metadata: Callable) -> tuple[list, list[str], list[str], list[dict]]:
+    """
+    Inserts rows in one transaction, flushing every INGEST_DB_BATCH_SIZE rows.
+    Returns their responses, ids, documents and metadatas.
+    """
+    batch_size = max(1, INGEST_DB_BATCH_SIZE)
+    with get_session() as session:
+        for start in range(0, len(rows), batch_size):
+            session.add_all(rows[start:start + batch_size])
+            session.flush()
+
+        return (
+            [respond(row) for row in rows],
+            [str(row.id) for row in rows],
+            [document(row) for row in rows],
+            [metadata(row) for row in rows]
+        )
+
+def bump_scopes(cache_scopes: set[str]):
+    with get_session() as session:
+        for scope in sorted(cache_scopes):
+            bump_version(session, scope)
+
+def remove_rows(model, ids: list[int], cache_scopes: set[str]):
+    batch_size = max(1, INGEST_DB_BATCH_SIZE)
+    with get_session() as session:
+        for start in range(0, len(ids), batch_size):
+            session.query(model).filter(model.id.in_(ids[start:start + batch_size])).delete(synchronize_session=False)
+        for scope in sorted(cache_scopes):
+            bump_version(session, scope)
+
+async def store_rows(
+    rows: list,
+    collection: str,
+    document: Callable,
+    metadata: Callable,
+    scopes: Callable[[list], set[str]],
+    respond: Callable,
+    atomic: bool,
+    progress: dict
+) -> list:
+    """
+    Inserts ORM rows in batches of INGEST_DB_BATCH_SIZE and adds them to the `collection` vector index in chunks.
+    `scopes` gives the result cache scopes invalidated by a batch, `respond` converts a stored row to its response.
+
+    With `atomic` every row is written in one transaction, and if indexing fails the rows are removed
+    from SQLite and the index again. The transaction is committed before indexing so the database is not
+    locked for other writers while embeddings are computed. Otherwise each batch is committed and indexed
+    on its own, a failure keeps the batches before it and the index catches up on the next start.
+
+    Like outbox changes, the cache scopes are bumped once the rows are in the index,
+    results computed while they were being indexed are stored under the old versions.
+    """
+    responses = []
+    batch_size = max(1, INGEST_DB_BATCH_SIZE)
+
+    try:
+        if atomic:
+            if rows:
+                # Stored rows are expired after the commit, what undoing them needs is taken beforehand
+                model = type(rows[0])
+                cache_scopes = scopes(rows)
+                responses, ids, documents, metadatas = await run_db(insert_rows, rows, respond, document, metadata)
+                progress["stored"] += len(rows)
+
+                try:
+                    await add_rows_chroma(collection, ids, documents, metadatas, index_progress(progress))
+                except Exception:
+                    try:
+                        await delete_rows_chroma(collection, ids)
+                    except Exception:
+                        # Index entries without a row are removed when the index is synced on the next start
+                        logger.exception(f"Upload {progress['id']}: could not remove indexed rows")
+                    finally:
+                        await run_db(remove_rows, model, [int(id) for id in ids], cache_scopes)
+                        progress["stored"] = 0
+                        progress["indexed"] = 0
+                    raise
+
+                await run_db(bump_scopes, cache_scopes)
+        else:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                cache_scopes = scopes(batch)
+                batch_responses, ids, documents, metadatas = await run_db(insert_rows, batch, respond, document, metadata)
+                responses.extend(batch_responses)
+                progress["stored"] += len(batch)
+
+                await add_rows_chroma(collection, ids, documents, metadatas, index_progress(progress))
+                await run_db(bump_scopes, cache_scopes)
+    except Exception as e:
+        progress["status"] = "failed"
+        progress["error"] = str(e)
+        raise
+
+    progress["status"] = "done"
+    logger.info(f"Upload {progress['id']}: {progress['stored']} {progress['kind']} stored, {progress['indexed']} indexed, {progress['skipped']} skipped")
+    return responses
@@ -1,127 +1,330 @@
-from chromadb import Client
+from chromadb import Client, PersistentClient
 from chromadb.api import ClientAPI
-from src.database.sqlite import Example, Schema, get_session
-from src.ai.embedding import embed_text
+from chromadb.api.models.Collection import Collection
+from src.database.sqlite import Example, Schema, get_session, run_db
+from sqlalchemy import func
+from src.ai.embedding import embed_text, embedding_model
+from src.utils.metrics import timed, record_stage
+from src.utils.batching import MicroBatcher
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from typing import Callable
+import asyncio
+import contextvars
+import functools
 import logging
 import json
+import os
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 chroma_client: ClientAPI
+# Collections opened at startup by name
+collections: dict[str, Collection] = {}
+
+# type -> number of examples, read from SQLite when needed and dropped whenever the examples index changes
+example_counts: dict[str, int] | None = None
+example_counts_generation = 0
+
+# Directory of the on-disk index. When unset the index lives in memory and is rebuilt on every start.
+CHROMA_PATH = os.getenv("CHROMA_PATH")
+# Number of rows embedded and written per request while syncing the index with SQLite or adding uploaded rows
+CHROMA_SYNC_BATCH_SIZE = int(os.getenv("CHROMA_SYNC_BATCH_SIZE", "256"))
+# Number of nearest results requested per query
+TYPES_TOP_K = int(os.getenv("TYPES_TOP_K", "7"))
+EXAMPLES_TEXTS_TOP_K = int(os.getenv("EXAMPLES_TEXTS_TOP_K", "5"))
+EXAMPLES_JSONS_TOP_K = int(os.getenv("EXAMPLES_JSONS_TOP_K", "3"))
+# Threads running Chroma calls, the HNSW search releases the GIL so queries of concurrent items use several cores
+CHROMA_THREADS = int(os.getenv("CHROMA_THREADS", str(min(8, os.cpu_count() or 1))))
+
+chroma_executor = ThreadPoolExecutor(max_workers=max(1, CHROMA_THREADS), thread_name_prefix="chroma")
+
+async def run_chroma(fn: Callable, *args, **kwargs):
+    """
+    Runs a blocking Chroma call on the Chroma threads so the event loop keeps serving other items.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(chroma_executor, contextvars.copy_context().run, functools.partial(fn, *args, **kwargs))
+
+def read_example_counts() -> dict[str, int]:
+    with get_session() as session:
+        return dict(session.query(Example.type, func.count(Example.id)).group_by(Example.type).all())
+
+def examples_changed(name: str):
+    global example_counts, example_counts_generation
+    if name == "examples":
+        example_counts = None
+        example_counts_generation += 1
+
+async def example_count(type: str) -> int:
+    global example_counts
+    if example_counts is None:
+        generation = example_counts_generation
+        counts = await run_db(read_example_counts)
+        # Counts read before a change landed must not replace the invalidation
+        if generation != example_counts_generation:
+            return counts.get(type, 0)
+        example_counts = counts
+    return example_counts.get(type, 0)
+
+def example_metadata(example: Example) -> dict:
+    return {"type": example.type, "normalized_json": json.dumps(example.normalized_json, ensure_ascii=False)}
+
+def schema_metadata(schema: Schema) -> dict:
+    return {"attributes": str(schema.attributes)}
+
+def open_collection(name: str) -> Collection:
+    """
+    Returns the collection, dropping it first if its vectors were produced by another embedding model.
+    """
+    global chroma_client
+    fingerprint = {"embed_model": embedding_model()}
+
+    collection = chroma_client.get_or_create_collection(name, metadata=fingerprint)
+    stored_model = (collection.metadata or {}).get("embed_model")
+    if stored_model != fingerprint["embed_model"]:
+        logger.info(f"Embedding model of '{name}' collection changed ({stored_model} -> {fingerprint['embed_model']}), rebuilding")
+        chroma_client.delete_collection(name)
+        collection = chroma_client.create_collection(name, metadata=fingerprint)
+
+    return collection
+
+async def sync_collection(collection: Collection, ids: list[str], documents: list[str], metadatas: list[dict], scope_ids: list[str] | None = None) -> dict[str, int]:
+    """
+    Brings the collection in line with the given rows.
+    Only rows that are new or whose document changed are embedded, metadata-only changes are updated in place
+    and rows missing from SQLite are removed. With `scope_ids` only these rows are compared, otherwise the whole collection.
+    Returns the number of embedded, updated and removed rows.
+    """
+    if scope_ids is None:
+        existing = await run_chroma(collection.get, include=["documents", "metadatas"])
+    else:
+        existing = await run_chroma(collection.get, ids=scope_ids, include=["documents", "metadatas"])
+    existing_documents = dict(zip(existing["ids"], existing["documents"]))
+    existing_metadatas = dict(zip(existing["ids"], existing["metadatas"]))
+
+    wanted_ids = set(ids)
+    stale_ids = [id for id in existing_documents if id not in wanted_ids]
+
+    to_embed = []
+    to_update = []
+    for i, id in enumerate(ids):
+        if existing_documents.get(id) != documents[i]:
+            to_embed.append(i)
+        elif existing_metadatas.get(id) != metadatas[i]:
+            to_update.append(i)
+
+    if stale_ids or to_update or to_embed:
+        examples_changed(collection.name)
+
+    for start in range(0, len(stale_ids), CHROMA_SYNC_BATCH_SIZE):
+        await run_chroma(collection.delete, ids=stale_ids[start:start + CHROMA_SYNC_BATCH_SIZE])
+
+    for start in range(0, len(to_update), CHROMA_SYNC_BATCH_SIZE):
+        batch = to_update[start:start + CHROMA_SYNC_BATCH_SIZE]
+        await run_chroma(
+            collection.update,
+            ids=[ids[i] for i in batch],
+            metadatas=[metadatas[i] for i in batch]
+        )
+
+    for start in range(0, len(to_embed), CHROMA_SYNC_BATCH_SIZE):
+        batch = to_embed[start:start + CHROMA_SYNC_BATCH_SIZE]
+        embeddings = await embed_text([documents[i] for i in batch])
+        await run_chroma(
+            collection.upsert,
+            ids=[ids[i] for i in batch],
+            embeddings=embeddings,
+            documents=[documents[i] for i in batch],
+            metadatas=[metadatas[i] for i in batch]
+        )
+
+    logger.info(
+        f"Synced '{collection.name}' collection: {len(ids)} rows, {len(to_embed)} embedded, "
+        f"{len(to_update)} metadata updates, {len(stale_ids)} removed"
+    )
+
+    return {"embedded": len(to_embed), "updated": len(to_update), "removed": len(stale_ids)}
 
 async def init_client():
     global chroma_client
-    chroma_client = Client()
+    chroma_client = PersistentClient(path=CHROMA_PATH) if CHROMA_PATH else Client()
 
     with get_session() as session:
         examples = session.query(Example).all()
         schemas = session.query(Schema).all()
 
-        examples_collection = chroma_client.get_or_create_collection("examples")
-        schemas_collection = chroma_client.get_or_create_collection("schemas")
+        examples_collection = open_collection("examples")
+        schemas_collection = open_collection("schemas")
+        collections.update({"examples": examples_collection, "schemas": schemas_collection})
 
-        if len(examples) > 0:
-            example_unnormalized_embeddings = await embed_text([example.unnormalized_text for example in examples])
-            examples_collection.add(
-                ids=[str(example.id) for example in examples],
-                embeddings=example_unnormalized_embeddings,
-                documents=[example.unnormalized_text for example in examples],
-                metadatas=[{"type": example.type, "normalized_json": json.dumps(example.normalized_json, ensure_ascii=False)} for example in examples]
-            )
+        await sync_collection(
+            examples_collection,
+            ids=[str(example.id) for example in examples],
+            documents=[example.unnormalized_text for example in examples],
+            metadatas=[example_metadata(example) for example in examples]
+        )
 
-        logger.info(f"Added {len(examples)} examples to the examples collection")
+        await sync_collection(
+            schemas_collection,
+            ids=[str(schema.id) for schema in schemas],
+            documents=[schema.type for schema in schemas],
+            metadatas=[schema_metadata(schema) for schema in schemas]
+        )
 
-        if len(schemas) > 0:
-            schema_embeddings = await embed_text([schema.type for schema in schemas])
-            schemas_collection.add(
-                ids=[str(schema.id) for schema in schemas],
-                embeddings=schema_embeddings,
-                documents=[schema.type for schema in schemas],
-                metadatas=[{"attributes": str(schema.attributes)} for schema in schemas]
-            )
+def query_collection(name: str, type: str | None, n_results: int, include: tuple[str, ...], query_embeddings: list[list[float]]) -> list[dict | None]:
+    """
+    Runs one query for several embeddings and returns the results of each, or None for each if the collection is empty.
+    """
+    collection = collections[name]
+    count = collection.count()
+    if count == 0:
+        return [None] * len(query_embeddings)
 
-        logger.info(f"Added {len(schemas)} schemas to the schemas collection")
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        where={"type": type} if type is not None else None,
+        n_results=min(n_results, count),
+        include=list(include)
+    )
+    return [{field: results[field][i] for field in ("ids", *include)} for i in range(len(query_embeddings))]
 
-async def get_examples(unnormalized_text: str, type: str) -> tuple[list[str], list[str]]:
-    global chroma_client
-    examples_collection = chroma_client.get_collection("examples")
+async def run_queries(queries: list[tuple[str, str | None, int, tuple[str, ...], list[float]]]) -> list[tuple[dict | None, float] | Exception]:
+    """
+    Answers (collection, type filter, n_results, include, embedding) queries, those that differ only
+    by the embedding are sent to Chroma as a single multi-embedding query.
+    Each answer comes with the duration of its Chroma query. A failed query fails only the queries of its group,
+    they get the exception in place of an answer.
+    """
+    groups = defaultdict(list)
+    for i, (name, type, n_results, include, _) in enumerate(queries):
+        groups[(name, type, n_results, include)].append(i)
+
+    results: list = [None] * len(queries)
 
-    text_embeddings = await embed_text([unnormalized_text])
+    async def run_group(key: tuple, indices: list[int]):
+        started = time.perf_counter()
+        group_results = await run_chroma(query_collection, *key, [queries[i][4] for i in indices])
+        elapsed = time.perf_counter() - started
+        for i, result in zip(indices, group_results):
+            results[i] = (result, elapsed)
+
+    outcomes = await asyncio.gather(*(run_group(key, indices) for key, indices in groups.items()), return_exceptions=True)
+    for indices, outcome in zip(groups.values(), outcomes):
+        if isinstance(outcome, Exception):
+            for i in indices:
+                results[i] = outcome
+    return results
+
+# Queries of concurrent items are coalesced like embedding requests
+query_dispatcher = MicroBatcher(
+    run_queries,
+    max_batch_size=int(os.getenv("CHROMA_BATCH_MAX_SIZE", "64")),
+    max_wait=float(os.getenv("CHROMA_BATCH_MAX_WAIT_MS", "2")) / 1000
+)
+
+async def query(name: str, type: str | None, n_results: int, include: tuple[str, ...], query_embedding: list[float]) -> dict | None:
+    # The query runs in a batch shared with other requests, its duration and the time spent waiting
+    # for the batch to fill are recorded for this request separately
+    started = time.perf_counter()
+    result, query_duration = (await query_dispatcher.submit([(name, type, n_results, include, query_embedding)]))[0]
+    record_stage("chroma_query", query_duration)
+    record_stage("chroma_batch_wait", max(0.0, time.perf_counter() - started - query_duration))
+    return result
+
+async def get_examples(unnormalized_text: str, type: str, query_embedding: list[float] | None = None) -> tuple[list[str], list[str]]:
+    query_embedding = query_embedding if query_embedding is not None else (await embed_text([unnormalized_text]))[0]
+
+    top_k = max(EXAMPLES_TEXTS_TOP_K, EXAMPLES_JSONS_TOP_K)
+    results = await query("examples", type, top_k, ("documents", "metadatas"), query_embedding)
 
-    # Get count of examples for this type
-    count = examples_collection.count()
-    
     # If no examples exist, return empty lists
-    if count == 0:
+    if results is None:
         return [], []
 
-    results = examples_collection.query(
-        query_embeddings=text_embeddings,
-        where={"type": type},
-        n_results=examples_collection.count(),
-    )
+    ids = results["ids"]
+    documents = results["documents"]
+    metadatas = results["metadatas"]
+
+    # Filtered ANN search may miss examples of a type, fill up from a plain lookup.
+    # A type with fewer than top_k examples comes back short by design and needs no lookup
+    if len(ids) < top_k and len(ids) < await example_count(type):
+        with timed("chroma_query"):
+            fallback = await run_chroma(
+                collections["examples"].get,
+                where={"type": type},
+                limit=top_k,
+                include=["documents", "metadatas"]
+            )
+        for id, document, metadata in zip(fallback["ids"], fallback["documents"], fallback["metadatas"]):
+            if id not in ids and len(ids) < top_k:
+                ids.append(id)
+                documents.append(document)
+                metadatas.append(metadata)
 
-    unnormalized_texts = results["documents"][0][:5]
+    unnormalized_texts = documents[:EXAMPLES_TEXTS_TOP_K]
     unnormalized_texts = [text.replace('неизвестно', '').strip() for text in unnormalized_texts]
-    normalized_jsons = [json.loads(result["normalized_json"]) for result in results["metadatas"][0][:3]]
+    normalized_jsons = [json.loads(result["normalized_json"]) for result in metadatas[:EXAMPLES_JSONS_TOP_K]]
 
     return unnormalized_texts, normalized_jsons
 
-async def get_types(unnormalized_text: str) -> list[str]:
-    global chroma_client
-    schemas_collection = chroma_client.get_collection("schemas")
+async def get_scored_types(unnormalized_text: str, query_embedding: list[float] | None = None) -> list[tuple[str, float]]:
+    """
+    Returns the nearest schema types with their distances, closest first.
+    """
+    query_embedding = query_embedding if query_embedding is not None else (await embed_text([unnormalized_text]))[0]
 
-    text_embeddings = await embed_text([unnormalized_text])
+    results = await query("schemas", None, TYPES_TOP_K, ("documents", "distances"), query_embedding)
+    if results is None:
+        return []
 
-    results = schemas_collection.query(
-        query_embeddings=text_embeddings,
-        n_results=schemas_collection.count(),
-    )
+    return list(zip(results["documents"], results["distances"]))
+
+async def get_types(unnormalized_text: str, query_embedding: list[float] | None = None) -> list[str]:
+    scored_types = await get_scored_types(unnormalized_text, query_embedding)
 
-    types = results["documents"][0][:7]
+    types = [type for type, _ in scored_types]
 
     return types
 
-async def add_example_chroma(example: Example):
-    global chroma_client
-    examples_collection = chroma_client.get_collection("examples")
-    
-    example_embedding = await embed_text([example.unnormalized_text])
-    
-    examples_collection.add(
-        ids=[str(example.id)],
-        embeddings=example_embedding,
-        documents=[example.unnormalized_text],
-        metadatas=[{"type": example.type, "normalized_json": json.dumps(example.normalized_json, ensure_ascii=False)}]
-    )
+async def get_nearest_example(unnormalized_text: str, query_embedding: list[float] | None = None) -> tuple[str, float] | None:
+    """
+    Returns the type of the closest example of any type and its distance.
+    """
+    query_embedding = query_embedding if query_embedding is not None else (await embed_text([unnormalized_text]))[0]
 
+    results = await query("examples", None, 1, ("metadatas", "distances"), query_embedding)
+    if results is None:
+        return None
 
-async def add_schema_chroma(schema: Schema):
-    global chroma_client
-    schemas_collection = chroma_client.get_collection("schemas")
-    
-    schema_embedding = await embed_text([schema.type])
-    
-    schemas_collection.add(
-        ids=[str(schema.id)],
-        embeddings=schema_embedding,
-        documents=[schema.type],
-        metadatas=[{
-            "attributes": str(schema.attributes)}
-        ]
-    )
+    return results["metadatas"][0]["type"], results["distances"][0]
 
+async def add_rows_chroma(name: str, ids: list[str], documents: list[str], metadatas: list[dict], on_progress: Callable[[int], None] | None = None):
+    """
+    Embeds and adds rows to a collection in chunks of CHROMA_SYNC_BATCH_SIZE,
+    with one embedding call and one write per chunk.
+    """
+    collection = collections[name]
+    examples_changed(name)
 
-async def delete_example_chroma(id: str):
-    global chroma_client
-    examples_collection = chroma_client.get_collection("examples")
-    
-    examples_collection.delete(ids=[id])
+    for start in range(0, len(ids), CHROMA_SYNC_BATCH_SIZE):
+        end = start + CHROMA_SYNC_BATCH_SIZE
+        embeddings = await embed_text(documents[start:end])
+        await run_chroma(
+            collection.add,
+            ids=ids[start:end],
+            embeddings=embeddings,
+            documents=documents[start:end],
+            metadatas=metadatas[start:end]
+        )
+        if on_progress is not None:
+            on_progress(len(ids[start:end]))
 
+async def delete_rows_chroma(name: str, ids: list[str]):
+    collection = collections[name]
+    examples_changed(name)
 
-async def delete_schema_chroma(id: str):
-    global chroma_client
-    schemas_collection = chroma_client.get_collection("schemas")
-    
-    schemas_collection.delete(ids=[id])
+    for start in range(0, len(ids), CHROMA_SYNC_BATCH_SIZE):
+        await run_chroma(collection.delete, ids=ids[start:start + CHROMA_SYNC_BATCH_SIZE])
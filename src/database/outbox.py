@@ -0,0 +1,155 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+from src.database.sqlite import Example, Schema, IndexChange, get_session, run_db
+from src.database import chroma
+from src.database.chroma import example_metadata, schema_metadata, sync_collection, run_chroma
+from src.database.result_cache import bump_version, examples_scope
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of outbox entries applied to the vector index per batch
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "256"))
+# Seconds between checks for pending entries when no change was signalled, also the retry delay after a failure
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+
+# collection -> (model, document, metadata, result cache scope of a row by its index metadata)
+COLLECTIONS = {
+    "examples": (Example, lambda example: example.unnormalized_text, example_metadata, lambda metadata: examples_scope(metadata["type"])),
+    "schemas": (Schema, lambda schema: schema.type, schema_metadata, lambda metadata: "schemas")
+}
+
+counters = {"embedded": 0, "updated": 0, "removed": 0, "failures": 0}
+
+wakeup = asyncio.Event()
+worker: asyncio.Task | None = None
+worker_loop: asyncio.AbstractEventLoop | None = None
+
+def record_change(session: Session, collection: str, row_id: int):
+    """
+    Queues a row for the vector index.
+    Called in the same session as the change to the row, so the change and its entry are committed together.
+    """
+    session.add(IndexChange(collection=collection, row_id=row_id))
+
+def notify():
+    # Wakes the worker once the session with the changes is committed, handlers may call it from a worker thread
+    if worker_loop is not None:
+        worker_loop.call_soon_threadsafe(wakeup.set)
+
+def read_pending() -> tuple[int | None, list[tuple]]:
+    """
+    Returns the id of the last entry of the next batch and the current state of its rows by collection,
+    as (collection, compared ids, ids, documents, metadatas).
+    """
+    with get_session() as session:
+        changes = session.query(IndexChange).order_by(IndexChange.id).limit(OUTBOX_BATCH_SIZE).all()
+        if not changes:
+            return None, []
+
+        changed_ids: dict[str, set[int]] = {}
+        for change in changes:
+            changed_ids.setdefault(change.collection, set()).add(change.row_id)
+
+        batches = []
+        for name, row_ids in changed_ids.items():
+            model, document, metadata, _ = COLLECTIONS[name]
+            rows = session.query(model).filter(model.id.in_(row_ids)).all()
+            batches.append((
+                name,
+                [str(id) for id in row_ids],
+                [str(row.id) for row in rows],
+                [document(row) for row in rows],
+                [metadata(row) for row in rows]
+            ))
+
+        return changes[-1].id, batches
+
+def remove_applied(last_id: int, scopes: set[str]) -> int:
+    """
+    Removes the applied entries and invalidates the cached results of the affected scopes in one transaction.
+    Results computed against the index before this batch was applied were stored under the old versions.
+    """
+    with get_session() as session:
+        for scope in sorted(scopes):
+            bump_version(session, scope)
+        return session.query(IndexChange).filter(IndexChange.id <= last_id).delete()
+
+async def sync_pending() -> int:
+    """
+    Applies up to OUTBOX_BATCH_SIZE pending entries and removes them from the outbox.
+    Entries of the same row are coalesced, the index is brought in line with the row as it is now,
+    so only rows whose text changed are embedded. Returns the number of applied entries.
+    """
+    last_id, batches = await run_db(read_pending)
+    if last_id is None:
+        return 0
+
+    scopes = set()
+    for name, scope_ids, ids, documents, metadatas in batches:
+        collection = chroma.collections[name]
+        cache_scope = COLLECTIONS[name][3]
+
+        # A changed or deleted example also invalidates the type it was indexed under
+        indexed = await run_chroma(collection.get, ids=scope_ids, include=["metadatas"])
+        scopes.update(cache_scope(metadata) for metadata in indexed["metadatas"] + metadatas)
+
+        applied = await sync_collection(collection, ids, documents, metadatas, scope_ids=scope_ids)
+        for action, count in applied.items():
+            counters[action] += count
+
+    # Entries added meanwhile have larger ids and stay for the next batch
+    return await run_db(remove_applied, last_id, scopes)
+
+async def run_worker():
+    while True:
+        wakeup.clear()
+        try:
+            applied = await sync_pending()
+        except Exception:
+            logger.exception("Vector index sync failed, retrying")
+            counters["failures"] += 1
+            applied = 0
+
+        # A full batch means more entries are likely waiting
+        if applied < OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+def start_worker():
+    global worker, worker_loop
+    worker_loop = asyncio.get_running_loop()
+    if worker is None or worker.done():
+        worker = asyncio.create_task(run_worker())
+
+async def stop_worker():
+    global worker
+    if worker is not None:
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+        worker = None
+
+def lag() -> dict:
+    """
+    Number of pending entries and the age in seconds of the oldest one.
+    """
+    with get_session() as session:
+        pending, oldest = session.query(func.count(IndexChange.id), func.min(IndexChange.created_at)).one()
+
+    age = 0.0
+    if oldest is not None:
+        # SQLite returns naive datetimes, they are stored in UTC
+        age = (datetime.now(timezone.utc).replace(tzinfo=None) - oldest.replace(tzinfo=None)).total_seconds()
+    return {"pending": pending, "lag_seconds": max(0.0, age)}
@@ -0,0 +1,79 @@
+from sqlalchemy.orm import Session
+from src.database.sqlite import CachedResult, CacheVersion, get_session, run_db
+from src.utils.metrics import timed
+import hashlib
+import json
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+
+counters = {"hits": 0, "misses": 0}
+
+def bump_version(session: Session, scope: str):
+    """
+    Invalidates every cached result that depends on `scope`.
+    Called in the same session as the change to schemas or examples, the new version is visible
+    to every process once that session is committed.
+    """
+    bumped = session.query(CacheVersion).filter(CacheVersion.scope == scope).update(
+        {CacheVersion.version: CacheVersion.version + 1},
+        synchronize_session=False
+    )
+    if not bumped:
+        session.add(CacheVersion(scope=scope, version=1))
+
+    # Results of older versions can never be hit again
+    session.query(CachedResult).filter(CachedResult.scope == scope).delete()
+
+def examples_scope(type: str) -> str:
+    return f"examples:{type}"
+
+def canonical_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def type_cache_key(text: str, model: str, prompt_fingerprint: str, fast_path_thresholds: tuple) -> str:
+    return _key("type", canonical_text(text), model, prompt_fingerprint, *fast_path_thresholds)
+
+def normalize_cache_key(text: str, type: str, attributes: list[str], model: str, prompt_fingerprint: str) -> str:
+    attributes_hash = hashlib.sha256(json.dumps(attributes, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return _key("normalize", canonical_text(text), type, model, prompt_fingerprint, attributes_hash)
+
+def read_cached(key: str, scope: str) -> tuple[str, object]:
+    """
+    Returns the key under the current version of `scope` and the result stored under it.
+    The version is read in the same session as the result, so a bump committed by any process is seen at once.
+    """
+    with timed("db"), get_session() as session:
+        version = session.get(CacheVersion, scope)
+        versioned_key = _key(key, version.version if version else 0)
+        row = session.get(CachedResult, versioned_key)
+        return versioned_key, row.result if row else None
+
+def write_cached(key: str, kind: str, scope: str, result):
+    with get_session() as session:
+        session.merge(CachedResult(key=key, kind=kind, scope=scope, result=result))
+
+async def get_cached(key: str, scope: str) -> tuple[str, object]:
+    """
+    Returns the versioned key to pass to put_cached and the cached result or None.
+    A result computed after a bump is stored under the version read here and is never served.
+    """
+    if not RESULT_CACHE_ENABLED:
+        return key, None
+
+    versioned_key, result = await run_db(read_cached, key, scope)
+
+    counters["hits" if result is not None else "misses"] += 1
+    return versioned_key, result
+
+async def put_cached(versioned_key: str, kind: str, scope: str, result):
+    if not RESULT_CACHE_ENABLED:
+        return
+
+    await run_db(write_cached, versioned_key, kind, scope, result)
+
+def _key(*parts) -> str:
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from src.database.sqlite import Schema, get_session
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def attributes_template(attributes: list[str]) -> str:
+    return "{\n" + "\n".join([f"    \"{attribute}\": \"...\"" + ("," if i < len(attributes) - 1 else "") for i, attribute in enumerate(attributes)]) + "\n}"
+
+def attributes_json_schema(attributes: list[str]) -> dict:
+    return {
+        "type": "object",
+        "properties": {attribute: {"type": "string"} for attribute in attributes},
+        "required": list(attributes),
+        "additionalProperties": False
+    }
+
+def batch_json_schema(attributes: list[str]) -> dict:
+    return {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"id": {"type": "integer"}, "attributes": attributes_json_schema(attributes)},
+                    "required": ["id", "attributes"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["items"],
+        "additionalProperties": False
+    }
+
+@dataclass(frozen=True)
+class SchemaEntry:
+    """
+    A schema with everything the prompts derive from its attributes, rendered once.
+    """
+    type: str
+    attributes: list[str]
+    attributes_lower: list[str]
+    attribute_set: frozenset[str]
+    template: str
+    json_schema: dict
+    batch_json_schema: dict
+
+def schema_entry(type: str, attributes: list[str]) -> SchemaEntry:
+    attributes_lower = [attribute.lower().strip() for attribute in attributes]
+    return SchemaEntry(
+        type=type,
+        attributes=list(attributes),
+        attributes_lower=attributes_lower,
+        attribute_set=frozenset(attributes_lower),
+        template=attributes_template(attributes),
+        json_schema=attributes_json_schema(attributes),
+        batch_json_schema=batch_json_schema(attributes)
+    )
+
+# type -> schema, loaded from the database on first use and reloaded whenever schemas change
+registry: dict[str, SchemaEntry] | None = None
+# Handlers reload from worker threads, a reload that read an older snapshot must not be assigned after a newer one
+registry_lock = threading.Lock()
+
+def load_registry():
+    """
+    Reads every schema. Called at startup and by the schemas router after a change is committed.
+    """
+    global registry
+    with registry_lock:
+        with get_session() as session:
+            registry = {schema.type: schema_entry(schema.type, schema.attributes) for schema in session.query(Schema).all()}
+        logger.info(f"Loaded {len(registry)} schemas")
+
+def get_schema(type: str) -> SchemaEntry | None:
+    if registry is None:
+        load_registry()
+    return registry.get(type)
@@ -1,11 +1,55 @@
-from sqlalchemy import Column, Integer, String, JSON, create_engine
+from sqlalchemy import Column, Integer, String, JSON, DateTime, ForeignKey, create_engine, event
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Generator
+from typing import Callable, Generator, TypeVar
+from datetime import datetime, timezone
+import asyncio
+import contextvars
+import os
 
-engine = create_engine("sqlite:///database.db")
+from dotenv import load_dotenv
+load_dotenv()
+
+T = TypeVar("T")
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db")
+# Connections kept open by the pool and extra ones opened under load
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "8"))
+# Seconds to wait for a free connection before failing
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Threads running database work for async code, more than the pool can serve would only wait for connections
+DB_THREADS = int(os.getenv("DB_THREADS", str(DB_POOL_SIZE)))
+# WAL lets readers run while a write is in progress, NORMAL sync is safe with WAL and avoids an fsync per commit
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Milliseconds a writer waits for the lock held by another connection before "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Page cache per connection in KiB
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT
+)
 Sessionmaker = sessionmaker(bind=engine)
 
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+db_executor = ThreadPoolExecutor(max_workers=max(1, DB_THREADS), thread_name_prefix="db")
+
 @contextmanager
 def get_session() -> Generator[Session, None, None]:
     session = Sessionmaker()
@@ -19,6 +63,15 @@ def get_session() -> Generator[Session, None, None]:
     finally:
         session.close()
 
+async def run_db(fn: Callable[..., T], *args) -> T:
+    """
+    Runs blocking database work on the database threads so the event loop keeps serving other requests.
+    `fn` opens its own sessions with get_session.
+    """
+    loop = asyncio.get_running_loop()
+    # The context carries request timings and trace ids into the thread
+    return await loop.run_in_executor(db_executor, contextvars.copy_context().run, fn, *args)
+
 
 
 Base = declarative_base()
@@ -36,4 +89,53 @@ class Schema(Base):
 
     id = Column(Integer, primary_key=True)
     type = Column(String, nullable=False, unique=True)
-    attributes = Column(JSON, nullable=False)
\ No newline at end of file
+    attributes = Column(JSON, nullable=False)
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)
+    # pending -> running -> done | failed
+    status = Column(String, nullable=False, default="pending")
+    total = Column(Integer, nullable=False)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+class JobRow(Base):
+    __tablename__ = "job_rows"
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, ForeignKey("jobs.id"), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    # Checkpoints: type is set once determined, normalized_json once normalized
+    type = Column(String, nullable=True)
+    normalized_json = Column(JSON, nullable=True)
+    # pending -> typed -> done
+    status = Column(String, nullable=False, default="pending")
+
+class CachedResult(Base):
+    __tablename__ = "result_cache"
+
+    key = Column(String, primary_key=True)
+    # "type" for determine_type results, "normalize" for normalize_text results
+    kind = Column(String, nullable=False)
+    # Version scope the result depends on, see CacheVersion
+    scope = Column(String, nullable=False, index=True)
+    result = Column(JSON, nullable=False)
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+
+    # "schemas" for the set of schemas, "examples:<type>" for the examples of a type
+    scope = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class IndexChange(Base):
+    __tablename__ = "index_outbox"
+
+    id = Column(Integer, primary_key=True)
+    # Vector index collection of the changed row, "examples" or "schemas"
+    collection = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
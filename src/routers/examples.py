@@ -1,13 +1,16 @@
-from fastapi import APIRouter, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, HTTPException, status, UploadFile, File, Query, Response
 from typing import List, Optional
-import pandas as pd
 import json
 import asyncio
+import uuid
 from pydantic import BaseModel
-from io import BytesIO
 from src.database.sqlite import Example, get_session
-from src.database.chroma import add_example_chroma, delete_example_chroma
+from src.database.chroma import example_metadata
+from src.database.outbox import record_change, notify
+from src.database.bulk import store_rows, start_upload, uploads
+from src.database.result_cache import examples_scope
 from src.utils.text_processing import normalize_quotes_for_json
+from src.utils.formats import detect_input_format, iter_input_rows
 
 router = APIRouter(prefix="/examples", tags=["examples"])
 
@@ -44,7 +47,7 @@ class ExampleResponse(ExampleBase):
         from_attributes = True
 
 @router.post("/", response_model=ExampleResponse, status_code=status.HTTP_201_CREATED)
-async def create_example(example: ExampleCreate):
+def create_example(example: ExampleCreate):
     with get_session() as session:
         db_example = Example(
             type=example.type,
@@ -55,8 +58,8 @@ async def create_example(example: ExampleCreate):
         session.flush()  # Flush to get the ID
         session.refresh(db_example)
         
-        # Add to Chroma vector database
-        await add_example_chroma(db_example)
+        # Queue for the vector database
+        record_change(session, "examples", db_example.id)
         
         # Create a copy of the data before closing the session
         example_data = ExampleResponse(
@@ -65,11 +68,12 @@ async def create_example(example: ExampleCreate):
             unnormalized_text=db_example.unnormalized_text,
             normalized_json=db_example.normalized_json
         )
-        
-        return example_data
+    
+    notify()
+    return example_data
 
 @router.get("/{example_id}", response_model=ExampleResponse)
-async def read_example(example_id: int):
+def read_example(example_id: int):
     with get_session() as session:
         db_example = session.query(Example).filter(Example.id == example_id).first()
         if db_example is None:
@@ -84,7 +88,7 @@ async def read_example(example_id: int):
         )
 
 @router.get("/", response_model=List[ExampleResponse])
-async def read_examples(type: Optional[str] = None):
+def read_examples(type: Optional[str] = None):
     with get_session() as session:
         query = session.query(Example)
         if type:
@@ -103,7 +107,7 @@ async def read_examples(type: Optional[str] = None):
         ]
 
 @router.put("/{example_id}", response_model=ExampleResponse)
-async def update_example(example_id: int, example: ExampleUpdate):
+def update_example(example_id: int, example: ExampleUpdate):
     with get_session() as session:
         db_example = session.query(Example).filter(Example.id == example_id).first()
         if db_example is None:
@@ -116,86 +120,109 @@ async def update_example(example_id: int, example: ExampleUpdate):
         session.flush()
         session.refresh(db_example)
         
-        # Update in Chroma vector database
-        await delete_example_chroma(str(db_example.id))
-        await add_example_chroma(db_example)
+        # Queue for the vector database, only a changed text is embedded again
+        record_change(session, "examples", db_example.id)
         
         # Create a copy of the data before closing the session
-        return ExampleResponse(
+        example_data = ExampleResponse(
             id=db_example.id,
             type=db_example.type,
             unnormalized_text=db_example.unnormalized_text,
             normalized_json=db_example.normalized_json
         )
+    
+    notify()
+    return example_data
 
 @router.delete("/{example_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_example(example_id: int):
+def delete_example(example_id: int):
     with get_session() as session:
         db_example = session.query(Example).filter(Example.id == example_id).first()
         if db_example is None:
             raise HTTPException(status_code=404, detail="Пример не найден")
         
-        # Store ID before deletion for Chroma
-        example_id_str = str(db_example.id)
+        # Queue the removal from the vector database
+        record_change(session, "examples", db_example.id)
         
         session.delete(db_example)
-        
-    # Delete from Chroma vector database
-    await delete_example_chroma(example_id_str)
-        
+    
+    notify()
     return None
 
+def example_from_row(row: str) -> Example:
+    # Replace curly quotes with straight quotes for JSON parsing
+    row_normalized = normalize_quotes_for_json(str(row))
+
+    # Parse JSON string to dict
+    try:
+        json_data = json.loads(row_normalized)
+        json_data = {k.lower().strip(): v.lower().strip() for k, v in json_data.items()}
+    except (json.JSONDecodeError, AttributeError):
+        raise ValueError("Строка не является JSON объектом со строковыми значениями")
+
+    # Extract type from "Тип" field
+    example_type = json_data.get("тип")
+    if not example_type:
+        raise ValueError("Тип не найден")
+
+    # Create unnormalized text by joining all values
+    unnormalized_text = " ".join(str(v) for v in json_data.values() if v.lower().strip() != "неизвестно")
+
+    return Example(
+        type=example_type,
+        unnormalized_text=unnormalized_text,
+        normalized_json=json_data
+    )
+
+def example_response(example: Example) -> ExampleResponse:
+    return ExampleResponse(
+        id=example.id,
+        type=example.type,
+        unnormalized_text=example.unnormalized_text,
+        normalized_json=example.normalized_json
+    )
+
 @router.post("/upload_from_xlsx", status_code=status.HTTP_201_CREATED, response_model=List[ExampleResponse])
-async def upload_from_xlsx(file: UploadFile = File(...)):
-    # Save the uploaded file temporarily
-    contents = await file.read()
-    
-    df = pd.read_excel(BytesIO(contents), header=None)
-    
-    rows = df.iloc[:, 0].to_list()
-    
-    created_examples = []
-    chroma_tasks = []
-    
-    # Process each row in the dataframe
-    with get_session() as session:
-        for row in rows:
-            # Replace curly quotes with straight quotes for JSON parsing
-            row_normalized = normalize_quotes_for_json(str(row))
-            
-            # Parse JSON string to dict
-            json_data = json.loads(row_normalized)
-            json_data = {k.lower().strip(): v.lower().strip() for k, v in json_data.items()}
-            
-            # Extract type from "Тип" field
-            example_type = json_data.get("тип")
-            if not example_type:
-                raise HTTPException(status_code=400, detail="Тип не найден")
-            
-            # Create unnormalized text by joining all values
-            unnormalized_text = " ".join(str(v) for v in json_data.values() if v.lower().strip() != "неизвестно")
-            
-            # Create example in database
-            db_example = Example(
-                type=example_type,
-                unnormalized_text=unnormalized_text,
-                normalized_json=json_data
-            )
-            session.add(db_example)
-            session.flush()  # Flush to get the ID
-            session.refresh(db_example)
-            
-            # Convert to Pydantic model before appending
-            created_examples.append(ExampleResponse(
-                id=db_example.id,
-                type=db_example.type,
-                unnormalized_text=db_example.unnormalized_text,
-                normalized_json=db_example.normalized_json
-            ))
-            
-            # Create task for adding to Chroma
-            chroma_tasks.append(add_example_chroma(db_example))
-
-        await asyncio.gather(*chroma_tasks)
-        
-        return created_examples
\ No newline at end of file
+async def upload_from_xlsx(
+    response: Response,
+    file: UploadFile = File(...),
+    format: str | None = Query(None, description="Формат файла: xlsx, csv, ndjson или parquet"),
+    atomic: bool = Query(True, description="Сохранить все строки или ни одной; иначе некорректные строки пропускаются, а пачки сохраняются по отдельности"),
+    upload_id: str | None = Query(None, description="Идентификатор для отслеживания прогресса загрузки")
+):
+    # Each row is a JSON object, in NDJSON the lines are the objects themselves
+    input_format = detect_input_format(format, file.content_type, file.filename)
+    rows = await asyncio.to_thread(lambda: list(iter_input_rows(file.file, input_format, field=None)))
+
+    progress = start_upload(upload_id or uuid.uuid4().hex, "examples", len(rows))
+    response.headers["X-Upload-ID"] = progress["id"]
+
+    examples = []
+    for i, row in enumerate(rows):
+        try:
+            examples.append(example_from_row(row))
+        except ValueError as e:
+            if atomic:
+                progress["status"] = "failed"
+                progress["error"] = f"Строка {i + 1}: {e}"
+                raise HTTPException(status_code=400, detail=progress["error"])
+            progress["skipped"] += 1
+
+    return await store_rows(
+        examples,
+        "examples",
+        document=lambda example: example.unnormalized_text,
+        metadata=example_metadata,
+        scopes=lambda batch: {examples_scope(example.type) for example in batch},
+        respond=example_response,
+        atomic=atomic,
+        progress=progress
+    )
+
+@router.get("/upload_from_xlsx/{upload_id}", response_model=dict)
+async def read_upload_progress(upload_id: str):
+    progress = uploads.get(upload_id)
+    if progress is None or progress["kind"] != "examples":
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+
+    return progress
@@ -0,0 +1,202 @@
+from fastapi import APIRouter, HTTPException, status, UploadFile, File, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from src.ai.llm import determine_type, normalize_text
+from src.ai.context import ItemContext
+from src.ai.scheduler import map_bounded
+from src.database.sqlite import Job, JobRow, get_session, run_db
+from src.database.schema_registry import get_schema
+from src.utils.spreadsheet import iter_file_chunks, NormalizedWorkbookWriter, XLSX_MEDIA_TYPE
+from src.utils.formats import detect_input_format, iter_input_rows
+from src.utils.tracing import trace_context
+import asyncio
+import logging
+import uuid
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+# Keeps references to running job tasks so they are not garbage collected
+running_jobs: dict[str, asyncio.Task] = {}
+
+class JobResponse(BaseModel):
+    id: str
+    status: str
+    total: int
+    typed: int
+    done: int
+    progress: float
+    error: str | None = None
+
+def job_response(session, job: Job) -> JobResponse:
+    typed = session.query(JobRow).filter(JobRow.job_id == job.id, JobRow.status != "pending").count()
+    done = session.query(JobRow).filter(JobRow.job_id == job.id, JobRow.status == "done").count()
+    return JobResponse(
+        id=job.id,
+        status=job.status,
+        total=job.total,
+        typed=typed,
+        done=done,
+        progress=round(done / job.total, 4) if job.total else 1.0,
+        error=job.error
+    )
+
+def set_job_status(job_id: str, job_status: str, error: str | None = None):
+    with get_session() as session:
+        job = session.query(Job).filter(Job.id == job_id).first()
+        job.status = job_status
+        job.error = error
+
+def save_row_type(row_id: int, row_type: str):
+    with get_session() as session:
+        row = session.query(JobRow).filter(JobRow.id == row_id).first()
+        row.type = row_type
+        row.status = "typed"
+
+def save_row_result(row_id: int, normalized_json: dict | None):
+    with get_session() as session:
+        row = session.query(JobRow).filter(JobRow.id == row_id).first()
+        row.normalized_json = normalized_json
+        row.status = "done"
+
+async def process_job_row(row_id: int, text: str, row_type: str | None):
+    context = ItemContext(text)
+
+    if row_type is None:
+        row_type = (await determine_type(text, context)).lower().strip()
+        await run_db(save_row_type, row_id, row_type)
+
+    schema = get_schema(row_type)
+    normalized_json = None
+    if row_type != "неизвестно" and schema and schema.attributes:
+        normalized_json = await normalize_text(text.strip().lower(), schema, context)
+
+    await run_db(save_row_result, row_id, normalized_json)
+
+def unfinished_rows(job_id: str) -> list[tuple[int, str, str | None]]:
+    with get_session() as session:
+        return [
+            (row.id, row.text, row.type)
+            for row in session.query(JobRow).filter(JobRow.job_id == job_id, JobRow.status != "done").order_by(JobRow.position)
+        ]
+
+async def run_job(job_id: str):
+    """
+    Processes the unfinished rows of a job. Rows that were already typed or normalized
+    before a restart are not sent to the LLM again.
+    """
+    await run_db(set_job_status, job_id, "running")
+    rows = await run_db(unfinished_rows, job_id)
+
+    logger.info(f"Job {job_id}: processing {len(rows)} unfinished rows")
+
+    try:
+        with trace_context(job_id=job_id):
+            await map_bounded(lambda row: process_job_row(*row), rows)
+        await run_db(set_job_status, job_id, "done")
+        logger.info(f"Job {job_id}: done")
+    except Exception as e:
+        logger.exception(f"Job {job_id} failed")
+        await run_db(set_job_status, job_id, "failed", str(e))
+    finally:
+        # map_bounded returns only after every row worker has stopped and the status is final by now,
+        # so a resume cannot start a second run next to this one
+        running_jobs.pop(job_id, None)
+
+def start_job(job_id: str):
+    if job_id not in running_jobs or running_jobs[job_id].done():
+        running_jobs[job_id] = asyncio.create_task(run_job(job_id))
+
+def resume_jobs():
+    """
+    Restarts jobs that were interrupted by a server shutdown.
+    """
+    with get_session() as session:
+        job_ids = [job.id for job in session.query(Job).filter(Job.status.in_(["pending", "running"]))]
+
+    for job_id in job_ids:
+        logger.info(f"Resuming job {job_id}")
+        start_job(job_id)
+
+def create_job(texts: list[str]) -> JobResponse:
+    with get_session() as session:
+        job = Job(id=uuid.uuid4().hex, status="pending", total=len(texts))
+        session.add(job)
+        session.add_all([
+            JobRow(job_id=job.id, position=position, text=text)
+            for position, text in enumerate(texts)
+        ])
+        session.flush()
+        return job_response(session, job)
+
+def read_job_response(job_id: str) -> JobResponse:
+    with get_session() as session:
+        job = session.query(Job).filter(Job.id == job_id).first()
+        if job is None:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+
+        return job_response(session, job)
+
+@router.post("/normalize_xlsx", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_normalize_xlsx(
+    file: UploadFile = File(...),
+    format: str | None = Query(None, description="Формат файла: xlsx, csv, ndjson или parquet")
+):
+    input_format = detect_input_format(format, file.content_type, file.filename)
+    # Parsed from the spooled upload off the event loop
+    first_column = await asyncio.to_thread(lambda: list(iter_input_rows(file.file, input_format)))
+
+    response = await run_db(create_job, first_column)
+
+    start_job(response.id)
+
+    return response
+
+@router.get("/{job_id}", response_model=JobResponse)
+async def read_job(job_id: str):
+    return await run_db(read_job_response, job_id)
+
+@router.post("/{job_id}/resume", response_model=JobResponse)
+async def resume_job(job_id: str):
+    if (await run_db(read_job_response, job_id)).status == "done":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Задача уже завершена")
+
+    start_job(job_id)
+
+    return await run_db(read_job_response, job_id)
+
+def collect_job_result(job_id: str) -> NormalizedWorkbookWriter:
+    with get_session() as session:
+        job = session.query(Job).filter(Job.id == job_id).first()
+        if job is None:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        if job.status != "done":
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Задача еще не завершена")
+
+        rows = session.query(JobRow).filter(JobRow.job_id == job_id).order_by(JobRow.position).yield_per(1000)
+
+        writer = NormalizedWorkbookWriter()
+        try:
+            for row in rows:
+                if row.type == "неизвестно":
+                    writer.add(row.type, {"text": row.text.strip().lower()}, row.text)
+                elif row.normalized_json is not None:
+                    writer.add(row.type, row.normalized_json, row.text)
+        except Exception:
+            writer.close()
+            raise
+
+    return writer
+
+@router.get("/{job_id}/result")
+async def read_job_result(job_id: str):
+    writer = await run_db(collect_job_result, job_id)
+    output = await asyncio.to_thread(writer.finish)
+
+    return StreamingResponse(
+        iter_file_chunks(output),
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": f"attachment; filename=normalized_data_{job_id}.xlsx"}
+    )
@@ -0,0 +1,73 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from src.ai.embedding_cache import embedding_cache
+from src.ai.llm import type_path_counters
+from src.ai.scheduler import llm_limiter, embedding_limiter
+from src.database import result_cache, outbox
+from src.utils.metrics import CallbackMetric, register, render
+
+router = APIRouter(tags=["metrics"])
+
+register(CallbackMetric(
+    "normalization_embedding_cache_lookups_total",
+    "Embedding cache lookups by result",
+    "counter",
+    lambda: [({"result": result}, value) for result, value in embedding_cache.counters.items()]
+))
+register(CallbackMetric(
+    "normalization_result_cache_lookups_total",
+    "Result cache lookups by result",
+    "counter",
+    lambda: [({"result": result}, value) for result, value in result_cache.counters.items()]
+))
+register(CallbackMetric(
+    "normalization_type_decisions_total",
+    "Items typed by each path of determine_type",
+    "counter",
+    lambda: [({"path": path}, value) for path, value in type_path_counters.items()]
+))
+register(CallbackMetric(
+    "normalization_backend_in_flight",
+    "Calls currently running against each backend",
+    "gauge",
+    lambda: [({"backend": limiter.name}, limiter.in_flight) for limiter in (llm_limiter, embedding_limiter)]
+))
+register(CallbackMetric(
+    "normalization_backend_concurrency_limit",
+    "Current concurrency limit of each backend",
+    "gauge",
+    lambda: [({"backend": limiter.name}, int(limiter.limit)) for limiter in (llm_limiter, embedding_limiter)]
+))
+register(CallbackMetric(
+    "normalization_index_sync_rows_total",
+    "Rows applied to the vector index from the outbox by action",
+    "counter",
+    lambda: [({"action": action}, outbox.counters[action]) for action in ("embedded", "updated", "removed")]
+))
+register(CallbackMetric(
+    "normalization_index_sync_failures_total",
+    "Failed attempts to apply outbox entries to the vector index",
+    "counter",
+    lambda: [({}, outbox.counters["failures"])]
+))
+# Read once per scrape by metrics_endpoint, both index sync gauges report from it
+index_lag = {"pending": 0, "lag_seconds": 0.0}
+
+register(CallbackMetric(
+    "normalization_index_sync_pending",
+    "Changes of schemas and examples not yet applied to the vector index",
+    "gauge",
+    lambda: [({}, index_lag["pending"])]
+))
+register(CallbackMetric(
+    "normalization_index_sync_lag_seconds",
+    "Age of the oldest change not yet applied to the vector index",
+    "gauge",
+    lambda: [({}, index_lag["lag_seconds"])]
+))
+
+# Not async: the index sync gauges query the database, FastAPI runs the handler on a worker thread
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    index_lag.update(outbox.lag())
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -1,147 +1,253 @@
-from fastapi import APIRouter, Body, UploadFile, File
+from fastapi import APIRouter, Body, UploadFile, File, Response, Request, Query
 from fastapi.responses import StreamingResponse
-from src.ai.llm import determine_type, normalize_text
-from src.database.sqlite import Schema, get_session
-from src.utils.text_processing import normalize_quotes_for_json
+from src.ai.llm import determine_type, normalize_text, normalize_many, type_path_counters
+from src.ai.context import ItemContext
+from src.ai.scheduler import map_bounded, llm_limiter, embedding_limiter, INGEST_CHUNK_ROWS, INGEST_MAX_CHUNKS_IN_FLIGHT
+from src.ai.embedding_cache import embedding_cache
+from src.ai.embedding import embedding_dispatcher
+from src.ai.recording import recorder
+from src.database import result_cache
+from src.database.schema_registry import get_schema
+from src.utils.text_processing import normalize_quotes_for_json, canonical_key
+from src.utils.metrics import request_timings, server_timing_header
+from src.utils.spreadsheet import iter_file_chunks, NormalizedWorkbookWriter
+from src.utils.formats import (
+    detect_input_format, detect_output_format, iter_input_rows, result_record, csv_header, encode_records, encode_summary,
+    ParquetResultWriter, MEDIA_TYPES
+)
+from src.utils.batching import iterate_in_thread
+from src.utils.result_spool import ResultSpool
 import pandas as pd
+import asyncio
 import io
+from contextlib import aclosing
+from typing import AsyncIterator, BinaryIO
 import json
-import asyncio
-from collections import defaultdict
-from openpyxl.utils import get_column_letter
+from collections import deque
 from rouge_score import rouge_scorer
 
 
 router = APIRouter(prefix="/processing", tags=["processing"])
 
+@router.get("/stats", response_model=dict)
+async def stats_endpoint():
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batches": embedding_dispatcher.counters,
+        "llm_concurrency": llm_limiter.stats(),
+        "embedding_concurrency": embedding_limiter.stats(),
+        "result_cache": result_cache.counters,
+        "type_paths": type_path_counters,
+        "recording": recorder.stats()
+    }
+
 @router.post("/normalize_text", response_model=dict)
-async def normalize_text_endpoint(text: str = Body(...)):
-    text = text.strip().lower()
-    type = await determine_type(text)
-    with get_session() as session:
-        schema = session.query(Schema).filter(Schema.type == type).first()
+async def normalize_text_endpoint(response: Response, text: str = Body(...)):
+    # Collect per-stage durations of this request for the Server-Timing header
+    timings = {}
+    token = request_timings.set(timings)
+    try:
+        text = text.strip().lower()
+        context = ItemContext(text)
+        type = await determine_type(text, context)
+        schema = get_schema(type)
         if type.lower().strip() == "неизвестно" or not schema:
             return {"тип": "неизвестно"}
-        attributes = schema.attributes
 
-    normalized_text = await normalize_text(text, type, attributes)
-    return normalized_text
+        normalized_text = await normalize_text(text, schema, context)
+        return normalized_text
+    finally:
+        request_timings.reset(token)
+        response.headers["Server-Timing"] = server_timing_header(timings)
 
-@router.post("/normalize_xlsx")
-async def normalize_xlsx_endpoint(file: UploadFile = File(...)):
-    # Read the XLSX file
-    contents = await file.read()
-    df = pd.read_excel(io.BytesIO(contents), header=None)
-    
-    # Extract first column texts
-    first_column_series = df.iloc[:, 0]
-    # Filter out NaN values and empty strings
-    first_column_series = first_column_series.dropna()
-    first_column = [str(text).strip() for text in first_column_series.tolist() if str(text).strip()]
-    
-    # Determine types in parallel
-    type_tasks = [determine_type(text) for text in first_column]
-    types = await asyncio.gather(*type_tasks)
+async def normalize_unique_chunk(items: list[tuple[str, str]], results: dict[str, tuple[str, dict | None]]):
+    """
+    Types and normalizes (key, text) items, storing (type, result) by key.
+    """
+    # Determine types in parallel, keeping each item's query embedding for example retrieval
+    contexts = [ItemContext(text) for _, text in items]
+    types = await map_bounded(lambda i: determine_type(items[i][1], contexts[i]), range(len(items)))
     types = [type.lower().strip() for type in types]
-    
-    # Group texts by type
-    type_to_texts = defaultdict(list)
-    for i, (text, type_name) in enumerate(zip(first_column, types)):
-        type_to_texts[type_name].append((i, text.strip().lower()))
-    
-    # Get schemas for each type
-    type_to_schema = {}
-    with get_session() as session:
-        for type_name in type_to_texts.keys():
-            if type_name != "неизвестно":
-                schema = session.query(Schema).filter(Schema.type == type_name).first()
-                if schema:
-                    type_to_schema[type_name] = schema.attributes
-    
-    # Normalize texts in parallel across all types
-    all_tasks = []
-    task_metadata = []
-    
-    for type_name, text_indices in type_to_texts.items():
-        if type_name == "неизвестно":
-            for idx, text in text_indices:
-                task_metadata.append((type_name, idx, None, text))
-        else:
-            attributes = type_to_schema.get(type_name, [])
-            if attributes:
-                # Create normalization tasks for this type
-                for idx, text in text_indices:
-                    task = normalize_text(text, type_name, attributes)
-                    all_tasks.append(task)
-                    task_metadata.append((type_name, idx, len(all_tasks)-1, None))
-    
-    # Execute all normalization tasks at once
-    all_results = await asyncio.gather(*all_tasks) if all_tasks else []
-    
-    # Organize results by type
-    normalized_data = defaultdict(list)
-    
-    for type_name, idx, task_idx, text in task_metadata:
-        if type_name == "неизвестно":
-            normalized_data[type_name].append((idx, {"text": text}))
+
+    tasks = []
+    task_keys = []
+    for (key, text), context, type_name in zip(items, contexts, types):
+        schema = get_schema(type_name) if type_name != "неизвестно" else None
+        if schema and schema.attributes:
+            tasks.append((text.strip().lower(), schema, context))
+            task_keys.append(key)
         else:
-            normalized_data[type_name].append((idx, all_results[task_idx]))
-    
-    # Create a new Excel file with sheets for each type
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        for type_name, data in normalized_data.items():
-            if data:
-                # Sort by original index to maintain order
-                sorted_data = sorted(data, key=lambda x: x[0])
-                
-                # Get all unique keys from the normalized data
-                keys = set()
-                for _, item in sorted_data:
-                    keys.update(item.keys())
-                
-                # Create DataFrame with all keys as columns
-                keys = sorted(list(keys)) # Sort keys for consistent column order
-                
-                rows = []
-                for idx, item in sorted_data:
-                    # Get the original text using the stored index
-                    original_text = first_column[idx]
-                    
-                    # Create row dictionary including normalized data, empty column, and original text
-                    row = {key: item.get(key, "") for key in keys}
-                    # Add an empty column (using an empty string as key, pandas will handle it)
-                    row[""] = "" 
-                    # Add the original text column
-                    row["Оригинал"] = original_text
-                    rows.append(row)
-                
-                # Define column order: normalized keys, empty column, original column
-                column_order = keys + ["", "Оригинал"]
-                
-                sheet_df = pd.DataFrame(rows, columns=column_order)
-                sheet_df.to_excel(writer, sheet_name=type_name, index=False)
-                
-                # Auto-adjust column widths to fit content
-                worksheet = writer.sheets[type_name]
-                for i, column in enumerate(sheet_df.columns):
-                    column_width = max(
-                        sheet_df[column].astype(str).map(len).max(),
-                        len(str(column))
-                    )
-                    # Add a little extra width for padding
-                    column_width = column_width + 2
-                    # Set column width (column index is i+1 because Excel is 1-indexed)
-                    worksheet.column_dimensions[get_column_letter(i+1)].width = column_width
-    
-    # Reset pointer to the beginning of the file
-    output.seek(0)
-    
-    # Return the XLSX file
+            # Unknown types and types without a schema are not normalized
+            results[key] = (type_name, None)
+
+    # Execute normalization tasks with a bounded number in flight, same-type items may share prompts
+    for key, task, result in zip(task_keys, tasks, await normalize_many(tasks)):
+        results[key] = (task[1].type, result)
+
+async def normalize_rows(chunks: AsyncIterator[list[str]], counters: dict[str, int]) -> AsyncIterator[list[tuple[str, str, dict | None]]]:
+    """
+    Normalizes streamed chunks of texts and yields (text, type, result) of every chunk's rows in input order.
+    Chunks are processed while the next ones are read. Rows of unknown type get {"text": ...} as the result,
+    rows of types without a schema get None. `counters` receives the number of rows and of distinct items.
+
+    Each distinct item is processed once, rows differing only by case, whitespace or punctuation share the result.
+    Results are held in memory only while their chunk is in flight, then they move to a spool on disk
+    from which later duplicates are served.
+    """
+    spool = ResultSpool()
+    # key -> results of the chunk in flight that processes the item, until the chunk is written to the spool
+    in_progress: dict[str, dict] = {}
+    chunk_slots = asyncio.Semaphore(INGEST_MAX_CHUNKS_IN_FLIGHT)
+    # (task processing the chunk's new items, (results, key, text) of the chunk's rows, keys of the new items) in input order
+    pending_chunks = deque()
+
+    async def process_chunk(items: list[tuple[str, str]], results: dict):
+        try:
+            await normalize_unique_chunk(items, results)
+        finally:
+            chunk_slots.release()
+
+    async def chunk_results(task: asyncio.Task | None, rows: list[tuple[dict, str, str]], new_keys: list[str]) -> list[tuple[str, str, dict | None]]:
+        if task is not None:
+            await task
+        if new_keys:
+            await asyncio.to_thread(spool.store, {key: in_progress[key][key] for key in new_keys})
+            for key in new_keys:
+                del in_progress[key]
+
+        # Fan each distinct item's result out to all of its rows
+        chunk = []
+        for results, key, text in rows:
+            type_name, result = results[key]
+            if type_name == "неизвестно":
+                result = {"text": text.strip().lower()}
+            chunk.append((text, type_name, result))
+        return chunk
+
+    try:
+        async for texts in chunks:
+            keys = [canonical_key(text) for text in texts]
+            # Items seen in chunks that are already written are read back from the spool
+            unseen = list({key for key in keys if key not in in_progress})
+            results = await asyncio.to_thread(spool.lookup, unseen) if unseen and counters["unique"] else {}
+
+            rows = []
+            new_items = []
+            for key, text in zip(keys, texts):
+                if key not in in_progress and key not in results:
+                    in_progress[key] = results
+                    new_items.append((key, text))
+                rows.append((in_progress.get(key, results), key, text))
+            counters["rows"] += len(rows)
+            counters["unique"] += len(new_items)
+
+            task = None
+            if new_items:
+                await chunk_slots.acquire()
+                task = asyncio.create_task(process_chunk(new_items, results))
+            pending_chunks.append((task, rows, [key for key, _ in new_items]))
+
+            # Rows only refer to items of their own or earlier chunks, so chunks are finished in input order
+            while pending_chunks and (pending_chunks[0][0] is None or pending_chunks[0][0].done()):
+                yield await chunk_results(*pending_chunks.popleft())
+
+        while pending_chunks:
+            yield await chunk_results(*pending_chunks.popleft())
+    finally:
+        for task, _, _ in pending_chunks:
+            if task is not None:
+                task.cancel()
+        spool.close()
+
+def detach_upload(file: UploadFile) -> BinaryIO:
+    # The form closes its files when the endpoint returns, a streamed response keeps reading the upload after that
+    upload, file.file = file.file, io.BytesIO()
+    return upload
+
+async def read_upload_rows(upload: BinaryIO, input_format: str) -> AsyncIterator[list[str]]:
+    # The upload is spooled to disk by the server, rows are parsed from it in a worker thread
+    try:
+        async with aclosing(iterate_in_thread(iter_input_rows(upload, input_format), INGEST_CHUNK_ROWS)) as chunks:
+            async for texts in chunks:
+                yield texts
+    finally:
+        upload.close()
+
+async def stream_records(rows: AsyncIterator[list[tuple[str, str, dict | None]]], output_format: str, counters: dict[str, int]) -> AsyncIterator[bytes]:
+    async with aclosing(rows):
+        if output_format == "csv":
+            yield csv_header()
+        index = 0
+        async for chunk in rows:
+            records = []
+            for text, type_name, result in chunk:
+                records.append(result_record(index, text, type_name, result))
+                index += 1
+            yield encode_records(records, output_format)
+    # The totals are only known at the end, they follow the rows instead of the X-Rows-* headers
+    yield encode_summary(dedup_summary(counters), output_format)
+
+def dedup_summary(counters: dict[str, int]) -> dict:
+    return {
+        "rows_total": counters["rows"],
+        "rows_unique": counters["unique"],
+        # Share of rows that were served from another row's result
+        "dedup_ratio": round(1 - counters["unique"] / counters["rows"], 4) if counters["rows"] else 0.0
+    }
+
+def dedup_headers(counters: dict[str, int]) -> dict[str, str]:
+    summary = dedup_summary(counters)
+    return {
+        "X-Rows-Total": str(summary["rows_total"]),
+        "X-Rows-Unique": str(summary["rows_unique"]),
+        "X-Dedup-Ratio": str(summary["dedup_ratio"])
+    }
+
+@router.post("/normalize_xlsx")
+async def normalize_xlsx_endpoint(
+    request: Request,
+    file: UploadFile = File(...),
+    format: str | None = Query(None, description="Формат файла: xlsx, csv, ndjson или parquet"),
+    output_format: str | None = Query(None, description="Формат результата, по умолчанию как у файла")
+):
+    input_format = detect_input_format(format, file.content_type, file.filename)
+    output_format = detect_output_format(output_format, request.headers.get("accept"), input_format)
+
+    # Rows are normalized chunk by chunk while the rest of the file is still being read
+    counters = {"rows": 0, "unique": 0}
+    rows = normalize_rows(read_upload_rows(detach_upload(file), input_format), counters)
+    filename = f"normalized_data.{output_format}"
+
+    # Row formats are streamed as chunks finish, the totals are not known when the headers are sent
+    if output_format in ("csv", "ndjson"):
+        return StreamingResponse(
+            stream_records(rows, output_format, counters),
+            media_type=MEDIA_TYPES[output_format],
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+
+    writer = NormalizedWorkbookWriter() if output_format == "xlsx" else ParquetResultWriter()
+    try:
+        async with aclosing(rows):
+            index = 0
+            async for chunk in rows:
+                if output_format == "xlsx":
+                    for text, type_name, result in chunk:
+                        if result is not None:
+                            writer.add(type_name, result, text)
+                else:
+                    writer.write([result_record(index + i, *row) for i, row in enumerate(chunk)])
+                index += len(chunk)
+        output = await asyncio.to_thread(writer.finish)
+    except BaseException:
+        writer.close()
+        raise
+
+    # Return the file, streamed from disk
     return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=normalized_data.xlsx"}
+        iter_file_chunks(output),
+        media_type=MEDIA_TYPES[output_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}", **dedup_headers(counters)}
     )
 
 @router.post("/validate_normalization", response_model=dict)
@@ -215,33 +321,23 @@ async def validate_normalization(file: UploadFile = File(...)):
     
     # Step 1: Determine types for all texts in parallel
     unnormalized_texts = [row["unnormalized_text"] for row in valid_rows]
-    type_tasks = [determine_type(text) for text in unnormalized_texts]
-    text_types = await asyncio.gather(*type_tasks)
-    
-    # Step 2: Get schemas for all determined types
-    type_to_attributes = {}
-    with get_session() as session:
-        for text_type in set(text_types):
-            if text_type.lower().strip() != "неизвестно":
-                schema = session.query(Schema).filter(Schema.type == text_type).first()
-                if schema:
-                    type_to_attributes[text_type] = schema.attributes
+    contexts = [ItemContext(text) for text in unnormalized_texts]
+    text_types = await map_bounded(lambda i: determine_type(unnormalized_texts[i], contexts[i]), range(len(unnormalized_texts)))
     
-    # Step 3: Create normalization tasks for texts with valid schemas
+    # Step 2: Create normalization tasks for texts with valid schemas
     normalization_tasks = []
     task_indices = []
     
     for i, (row, text_type) in enumerate(zip(valid_rows, text_types)):
-        attributes = type_to_attributes.get(text_type, [])
-        if text_type.lower().strip() != "неизвестно" and attributes:
-            task = normalize_text(row["unnormalized_text"], text_type, attributes)
-            normalization_tasks.append(task)
+        schema = get_schema(text_type) if text_type.lower().strip() != "неизвестно" else None
+        if schema and schema.attributes:
+            normalization_tasks.append((row["unnormalized_text"], schema, contexts[i]))
             task_indices.append(i)
     
-    # Step 4: Execute all normalization tasks in parallel
-    normalization_results = await asyncio.gather(*normalization_tasks) if normalization_tasks else []
+    # Step 3: Execute all normalization tasks in parallel
+    normalization_results = await normalize_many(normalization_tasks)
     
-    # Step 5: Process results and build response
+    # Step 4: Process results and build response
     results = []
     
     for i, (row, text_type) in enumerate(zip(valid_rows, text_types)):
@@ -1,13 +1,16 @@
-from fastapi import APIRouter, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, HTTPException, status, UploadFile, File, Query, Response
 from typing import List, Optional
 from pydantic import BaseModel
-from src.database.sqlite import Schema, get_session
-from src.database.chroma import add_schema_chroma, delete_schema_chroma
+from src.database.sqlite import Schema, get_session, run_db
+from src.database.chroma import schema_metadata
+from src.database.outbox import record_change, notify
+from src.database.schema_registry import load_registry
+from src.database.bulk import store_rows, start_upload, uploads
 from src.utils.text_processing import normalize_quotes_for_json
-import pandas as pd
+from src.utils.formats import detect_input_format, iter_input_rows
 import json
 import asyncio
-from io import BytesIO
+import uuid
 
 router = APIRouter(prefix="/schemas", tags=["schemas"])
 
@@ -39,7 +42,7 @@ class SchemaResponse(SchemaBase):
         from_attributes = True
 
 @router.post("/", response_model=SchemaResponse, status_code=status.HTTP_201_CREATED)
-async def create_schema(schema: SchemaCreate):
+def create_schema(schema: SchemaCreate):
     with get_session() as session:
         # Check if schema type already exists
         existing = session.query(Schema).filter(Schema.type == schema.type).first()
@@ -57,8 +60,8 @@ async def create_schema(schema: SchemaCreate):
         session.flush()
         session.refresh(db_schema)
         
-        # Add to Chroma vector database
-        await add_schema_chroma(db_schema)
+        # Queue for the vector database
+        record_change(session, "schemas", db_schema.id)
         
         # Create a copy of the data before closing the session
         schema_data = SchemaResponse(
@@ -66,11 +69,13 @@ async def create_schema(schema: SchemaCreate):
             type=db_schema.type,
             attributes=db_schema.attributes
         )
-        
-        return schema_data
+    
+    load_registry()
+    notify()
+    return schema_data
 
 @router.get("/{schema_id}", response_model=SchemaResponse)
-async def read_schema(schema_id: int):
+def read_schema(schema_id: int):
     with get_session() as session:
         db_schema = session.query(Schema).filter(Schema.id == schema_id).first()
         if db_schema is None:
@@ -113,7 +118,7 @@ def read_schemas(skip: int = 0, limit: int = 100):
         ]
 
 @router.put("/{schema_id}", response_model=SchemaResponse)
-async def update_schema(schema_id: int, schema: SchemaUpdate):
+def update_schema(schema_id: int, schema: SchemaUpdate):
     with get_session() as session:
         db_schema = session.query(Schema).filter(Schema.id == schema_id).first()
         if db_schema is None:
@@ -136,89 +141,123 @@ async def update_schema(schema_id: int, schema: SchemaUpdate):
         session.flush()
         session.refresh(db_schema)
         
-        # Update in Chroma vector database
-        await delete_schema_chroma(str(db_schema.id))
-        await add_schema_chroma(db_schema)
+        # Queue for the vector database
+        record_change(session, "schemas", db_schema.id)
         
         # Create a copy of the data before closing the session
-        return SchemaResponse(
+        schema_data = SchemaResponse(
             id=db_schema.id,
             type=db_schema.type,
             attributes=db_schema.attributes
         )
+    
+    load_registry()
+    notify()
+    return schema_data
 
 @router.delete("/{schema_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_schema(schema_id: int):
+def delete_schema(schema_id: int):
     with get_session() as session:
         db_schema = session.query(Schema).filter(Schema.id == schema_id).first()
         if db_schema is None:
             raise HTTPException(status_code=404, detail="Схема не найдена")
         
-        # Store ID before deletion for Chroma
-        schema_id_str = str(db_schema.id)
+        # Queue the removal from the vector database
+        record_change(session, "schemas", db_schema.id)
         
         session.delete(db_schema)
-        
-        # Delete from Chroma vector database
-        await delete_schema_chroma(schema_id_str)
-        
+    
+    load_registry()
+    notify()
     return None
 
-@router.post("/upload_from_xlsx", status_code=status.HTTP_201_CREATED, response_model=List[SchemaResponse])
-async def upload_from_xlsx(file: UploadFile = File(...)):
-    # Save the uploaded file temporarily
-    contents = await file.read()
-    
-    df = pd.read_excel(BytesIO(contents), header=None)
-    
-    # Get JSON objects from the first column
-    rows = df.iloc[:, 0].to_list()
-    
-    created_schemas = []
-    chroma_tasks = []
-    
-    # Process each row in the dataframe
+def read_schema_types() -> set[str]:
     with get_session() as session:
-        for i, row in enumerate(rows):  # Added enumerate to get index
-            print(f"Processing row {i}: {row}")  # Added print statement
-            
-            # Replace curly quotes with straight quotes for JSON parsing
-            row_normalized = normalize_quotes_for_json(str(row))
-            
-            # Parse JSON string to dict
-            json_data = json.loads(row_normalized)
-            json_data = {k.lower().strip(): v.lower().strip() for k, v in json_data.items()}
-
-            # Extract type from "тип" field
-            schema_type = json_data.get("тип")
-            if not schema_type:
-                raise HTTPException(status_code=400, detail="Поле 'тип' не найдено")
-            
-            # Check if schema type already exists
-            existing = session.query(Schema).filter(Schema.type == schema_type).first()
-            if existing:
-                continue  # Skip existing schemas
-            
-            # Create schema in database
-            db_schema = Schema(
-                type=schema_type,
-                attributes=list(json_data.keys())
-            )
+        return {type for (type,) in session.query(Schema.type)}
 
-            session.add(db_schema)
-            session.flush()  # Flush to get the ID
-            session.refresh(db_schema)
-            
-            # Convert to Pydantic model before appending
-            created_schemas.append(SchemaResponse(
-                id=db_schema.id,
-                type=db_schema.type,
-                attributes=db_schema.attributes
-            ))
-            
-            # Create task for adding to Chroma
-            chroma_tasks.append(add_schema_chroma(db_schema))
-    
-        await asyncio.gather(*chroma_tasks)
-        
-        return created_schemas
\ No newline at end of file
+def schema_from_row(row: str) -> Schema:
+    # Replace curly quotes with straight quotes for JSON parsing
+    row_normalized = normalize_quotes_for_json(str(row))
+
+    # Parse JSON string to dict
+    try:
+        json_data = json.loads(row_normalized)
+        json_data = {k.lower().strip(): v.lower().strip() for k, v in json_data.items()}
+    except (json.JSONDecodeError, AttributeError):
+        raise ValueError("Строка не является JSON объектом со строковыми значениями")
+
+    # Extract type from "тип" field
+    schema_type = json_data.get("тип")
+    if not schema_type:
+        raise ValueError("Поле 'тип' не найдено")
+
+    return Schema(
+        type=schema_type,
+        attributes=list(json_data.keys())
+    )
+
+def schema_response(schema: Schema) -> SchemaResponse:
+    return SchemaResponse(
+        id=schema.id,
+        type=schema.type,
+        attributes=schema.attributes
+    )
+
+@router.post("/upload_from_xlsx", status_code=status.HTTP_201_CREATED, response_model=List[SchemaResponse])
+async def upload_from_xlsx(
+    response: Response,
+    file: UploadFile = File(...),
+    format: str | None = Query(None, description="Формат файла: xlsx, csv, ndjson или parquet"),
+    atomic: bool = Query(True, description="Сохранить все строки или ни одной; иначе некорректные строки пропускаются, а пачки сохраняются по отдельности"),
+    upload_id: str | None = Query(None, description="Идентификатор для отслеживания прогресса загрузки")
+):
+    # Each row is a JSON object, in NDJSON the lines are the objects themselves
+    input_format = detect_input_format(format, file.content_type, file.filename)
+    rows = await asyncio.to_thread(lambda: list(iter_input_rows(file.file, input_format, field=None)))
+
+    progress = start_upload(upload_id or uuid.uuid4().hex, "schemas", len(rows))
+    response.headers["X-Upload-ID"] = progress["id"]
+
+    # Existing types and repeated types of the file are skipped, the first row of a type wins
+    seen_types = await run_db(read_schema_types)
+
+    schemas = []
+    for i, row in enumerate(rows):
+        try:
+            schema = schema_from_row(row)
+        except ValueError as e:
+            if atomic:
+                progress["status"] = "failed"
+                progress["error"] = f"Строка {i + 1}: {e}"
+                raise HTTPException(status_code=400, detail=progress["error"])
+            progress["skipped"] += 1
+            continue
+
+        if schema.type in seen_types:
+            progress["skipped"] += 1
+            continue
+        seen_types.add(schema.type)
+        schemas.append(schema)
+
+    try:
+        return await store_rows(
+            schemas,
+            "schemas",
+            document=lambda schema: schema.type,
+            metadata=schema_metadata,
+            scopes=lambda batch: {"schemas"} if batch else set(),
+            respond=schema_response,
+            atomic=atomic,
+            progress=progress
+        )
+    finally:
+        # Batches stored before a failure are committed in the non-atomic mode
+        await run_db(load_registry)
+
+@router.get("/upload_from_xlsx/{upload_id}", response_model=dict)
+async def read_upload_progress(upload_id: str):
+    progress = uploads.get(upload_id)
+    if progress is None or progress["kind"] != "schemas":
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+
+    return progress
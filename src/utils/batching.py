@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Generic, Iterable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Coalesces items submitted by concurrent callers into batches.
+    A batch is handed to `handler` once it holds `max_batch_size` items or `max_wait` seconds
+    after its first item arrived, whichever comes first. `handler` must return one result per item,
+    an Exception in place of a result is raised to the caller of that item only.
+    """
+
+    def __init__(self, handler: Callable[[list[T]], Awaitable[list[R]]], max_batch_size: int, max_wait: float):
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.pending: list[tuple[T, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.counters = {"items": 0, "batches": 0}
+        # The loop keeps only weak references to tasks, running batches are held here until they finish
+        self.running: set[asyncio.Task] = set()
+
+    async def submit(self, items: list[T]) -> list[R]:
+        if not items:
+            return []
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for item in items:
+            future = loop.create_future()
+            self.pending.append((item, future))
+            futures.append(future)
+
+            if len(self.pending) >= self.max_batch_size:
+                self._flush()
+
+        if self.pending and self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self._flush)
+
+        return list(await asyncio.gather(*futures))
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        while self.pending:
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: list[tuple[T, asyncio.Future]]):
+        self.counters["items"] += len(batch)
+        self.counters["batches"] += 1
+
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except asyncio.CancelledError:
+            # Callers waiting on the batch must not hang when it is cancelled
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+_END = object()
+
+async def iterate_in_thread(iterable: Iterable[T], chunk_size: int, max_chunks: int = 2) -> AsyncIterator[list[T]]:
+    """
+    Consumes a blocking iterable in a worker thread and yields its items in lists of `chunk_size`.
+    At most `max_chunks` chunks are buffered, the thread waits while the consumer is behind.
+    Use with contextlib.aclosing so the thread stops when the consumer does.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_chunks))
+    stopped = threading.Event()
+
+    def put(item):
+        if not stopped.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            chunk = []
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    put(chunk)
+                    chunk = []
+            if chunk:
+                put(chunk)
+            put(_END)
+        except Exception as e:
+            put(e)
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+
+    producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        # A producer blocked on a full queue only notices the stop once there is room
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait([producer], timeout=0.01)
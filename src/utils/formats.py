@@ -0,0 +1,218 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+from typing import IO, BinaryIO, Iterator
+from src.utils.metrics import timed, stage_duration
+from src.utils.spreadsheet import iter_first_column, XLSX_MEDIA_TYPE
+
+# Parquet support is optional, it needs pyarrow
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+FORMATS = ("xlsx", "csv", "ndjson", "parquet")
+
+MEDIA_TYPES = {
+    "xlsx": XLSX_MEDIA_TYPE,
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+CONTENT_TYPE_FORMATS = {
+    **{media_type: format for format, media_type in MEDIA_TYPES.items()},
+    "application/csv": "csv",
+    "application/jsonl": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/x-parquet": "parquet"
+}
+
+EXTENSION_FORMATS = {".xlsx": "xlsx", ".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson", ".parquet": "parquet"}
+
+# Columns of the row-oriented result formats
+RESULT_COLUMNS = ["row", "original", "type", "normalized"]
+
+class FormatError(ValueError):
+    pass
+
+class FormatUnavailableError(FormatError):
+    pass
+
+def check_format(format: str) -> str:
+    format = format.lower().strip()
+    if format not in FORMATS:
+        raise FormatError(f"Неизвестный формат '{format}', поддерживаются: {', '.join(FORMATS)}")
+    if format == "parquet" and pyarrow is None:
+        raise FormatUnavailableError("Для формата parquet требуется пакет pyarrow")
+    return format
+
+def detect_input_format(requested: str | None, content_type: str | None, filename: str | None) -> str:
+    """
+    Format of an upload: the requested one, else by content type, else by file extension, else xlsx.
+    """
+    if requested:
+        return check_format(requested)
+
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in CONTENT_TYPE_FORMATS:
+        return check_format(CONTENT_TYPE_FORMATS[media_type])
+
+    extension = os.path.splitext(filename or "")[1].lower()
+    return check_format(EXTENSION_FORMATS.get(extension, "xlsx"))
+
+def detect_output_format(requested: str | None, accept: str | None, default: str) -> str:
+    """
+    Format of a result: the requested one, else the first known media type of the Accept header, else `default`.
+    """
+    if requested:
+        return check_format(requested)
+
+    for media_type in (accept or "").split(","):
+        media_type = media_type.split(";")[0].strip().lower()
+        if media_type in CONTENT_TYPE_FORMATS:
+            return check_format(CONTENT_TYPE_FORMATS[media_type])
+
+    return default
+
+def cell_text(value, field: str | None) -> str | None:
+    """
+    Text of a first-column value. Objects give their `field`, or are kept as JSON if `field` is None.
+    """
+    if isinstance(value, dict):
+        if field is None:
+            return json.dumps(value, ensure_ascii=False)
+        value = value.get(field)
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text or None
+
+def parse_timed(values: Iterator, stage: str) -> Iterator:
+    # Only the time spent parsing counts, not the time the consumer holds a value
+    parse_time = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                value = next(values)
+            except StopIteration:
+                parse_time += time.perf_counter() - started
+                return
+            parse_time += time.perf_counter() - started
+            yield value
+    finally:
+        stage_duration.observe(parse_time, stage=stage)
+
+def iter_csv_values(file: BinaryIO) -> Iterator[str]:
+    text_file = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        for row in csv.reader(text_file):
+            if row:
+                yield row[0]
+    finally:
+        # Leaves the upload open for its owner
+        text_file.detach()
+
+def iter_ndjson_values(file: BinaryIO) -> Iterator:
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+def iter_parquet_values(file: BinaryIO) -> Iterator:
+    parquet_file = parquet.ParquetFile(file)
+    first_column = parquet_file.schema_arrow.names[0]
+    for batch in parquet_file.iter_batches(columns=[first_column]):
+        yield from batch.column(0).to_pylist()
+
+def iter_input_rows(file: BinaryIO, format: str, field: str | None = "text") -> Iterator[str]:
+    """
+    Yields the non-empty texts of the first column of an upload row by row.
+    In NDJSON every line is a text or an object, objects give their `field` or, if it is None, their JSON.
+    """
+    if format == "xlsx":
+        yield from parse_timed(iter_first_column(file), "xlsx_parse")
+        return
+
+    readers = {"csv": iter_csv_values, "ndjson": iter_ndjson_values, "parquet": iter_parquet_values}
+    for value in parse_timed(readers[format](file), f"{format}_parse"):
+        text = cell_text(value, field)
+        if text is not None:
+            yield text
+
+def result_record(row: int, original: str, type: str, normalized: dict | None) -> dict:
+    return {"row": row, "original": original, "type": type, "normalized": normalized}
+
+def csv_header() -> bytes:
+    return encode_records([], "csv", header=True)
+
+def encode_records(records: list[dict], format: str, header: bool = False) -> bytes:
+    """
+    Encodes result records as CSV rows, the normalized attributes as a JSON string, or as NDJSON lines.
+    """
+    if format == "ndjson":
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    if header:
+        writer.writerow(RESULT_COLUMNS)
+    for record in records:
+        normalized = record["normalized"]
+        writer.writerow([
+            record["row"],
+            record["original"],
+            record["type"],
+            json.dumps(normalized, ensure_ascii=False) if normalized is not None else ""
+        ])
+    return output.getvalue().encode("utf-8")
+
+def encode_summary(summary: dict, format: str) -> bytes:
+    """
+    Trailing record of a streamed result: an NDJSON line {"summary": ...},
+    or a CSV row with "summary" in the row column and the summary as JSON in the normalized column.
+    """
+    if format == "ndjson":
+        return (json.dumps({"summary": summary}, ensure_ascii=False) + "\n").encode("utf-8")
+
+    output = io.StringIO()
+    csv.writer(output).writerow(["summary", "", "", json.dumps(summary, ensure_ascii=False)])
+    return output.getvalue().encode("utf-8")
+
+class ParquetResultWriter:
+    """
+    Writes result records to a temporary Parquet file, a row group per `write` call.
+    """
+
+    def __init__(self):
+        self.schema = pyarrow.schema([
+            ("row", pyarrow.int64()),
+            ("original", pyarrow.string()),
+            ("type", pyarrow.string()),
+            ("normalized", pyarrow.string())
+        ])
+        self.output = tempfile.TemporaryFile()
+        self.writer = parquet.ParquetWriter(self.output, self.schema)
+
+    def write(self, records: list[dict]):
+        if not records:
+            return
+        with timed("parquet_write"):
+            self.writer.write_table(pyarrow.Table.from_pylist([
+                {**record, "normalized": json.dumps(record["normalized"], ensure_ascii=False) if record["normalized"] is not None else None}
+                for record in records
+            ], schema=self.schema))
+
+    def finish(self) -> IO[bytes]:
+        self.writer.close()
+        self.output.seek(0)
+        return self.output
+
+    def close(self):
+        self.writer.close()
+        self.output.close()
@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+import threading
+import time
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[tuple, float] = {}
+        # Updated from the event loop and from worker threads (database, file parsing and writing)
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> (count per bucket, sum, count)
+        self.series: dict[tuple, tuple[list[int], float, int]] = {}
+        # Buckets, sum and count of a series change together, see Counter.lock
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            bucket_counts, total, count = self.series.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            self.series[key] = (bucket_counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labels, (list(bucket_counts), total, count)) for labels, (bucket_counts, total, count) in self.series.items()]
+        for labels, (bucket_counts, total, count) in series:
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+class CallbackMetric:
+    """
+    Counter or gauge whose samples are read from a callback at scrape time.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, collect: Callable[[], list[tuple[dict, float]]]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.collect():
+            lines.append(f"{self.name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return lines
+
+registry: list[Counter | Histogram | CallbackMetric] = []
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+stage_duration = register(Histogram(
+    "normalization_stage_duration_seconds",
+    "Duration of pipeline stages: embedding, chroma_query, llm, db, xlsx_parse, xlsx_write"
+))
+llm_tokens = register(Histogram(
+    "normalization_llm_tokens",
+    "Tokens per LLM call by call and kind (prompt or completion)",
+    buckets=TOKEN_BUCKETS
+))
+json_parse_failures = register(Counter(
+    "normalization_json_parse_failures_total",
+    "LLM answers that could not be parsed as JSON"
+))
+embedded_texts = register(Counter(
+    "normalization_embedded_texts_total",
+    "Texts sent to the embedding server"
+))
+
+# Per-request stage durations in milliseconds, reported in the Server-Timing header
+request_timings: ContextVar[dict[str, float] | None] = ContextVar("request_timings", default=None)
+# Work of one request may record stages from several worker threads at once
+request_timings_lock = threading.Lock()
+
+def record_stage(stage: str, elapsed: float, **labels):
+    """
+    Records a duration measured elsewhere, e.g. in a batch shared by several requests, for the current request.
+    """
+    stage_duration.observe(elapsed, stage=stage, **labels)
+    timings = request_timings.get()
+    if timings is not None:
+        with request_timings_lock:
+            timings[stage] = timings.get(stage, 0.0) + elapsed * 1000
+
+@contextmanager
+def timed(stage: str, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, **labels)
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={duration:.1f}" for stage, duration in timings.items())
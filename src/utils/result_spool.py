@@ -0,0 +1,50 @@
+import json
+import sqlite3
+import threading
+
+# Keys per lookup query, stays below SQLite's limit on bound parameters
+LOOKUP_BATCH_SIZE = 500
+
+class ResultSpool:
+    """
+    (type, result) of the distinct items of one upload by canonical key, kept in a temporary SQLite file.
+    Later duplicates are served from it, so memory does not grow with the number of distinct items.
+    Methods block, call them from a worker thread.
+    """
+
+    def __init__(self):
+        # An empty path is a private temporary database on disk, removed when the connection is closed
+        self.connection = sqlite3.connect("", check_same_thread=False)
+        # Nothing to recover after a crash, the file only lives as long as the upload
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE results (key TEXT PRIMARY KEY, type TEXT NOT NULL, result TEXT)")
+        self.lock = threading.Lock()
+
+    def lookup(self, keys: list[str]) -> dict[str, tuple[str, dict | None]]:
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[start:start + LOOKUP_BATCH_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT key, type, result FROM results WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, type_name, result in rows:
+                    found[key] = (type_name, json.loads(result) if result is not None else None)
+        return found
+
+    def store(self, items: dict[str, tuple[str, dict | None]]):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results (key, type, result) VALUES (?, ?, ?)",
+                [
+                    (key, type_name, json.dumps(result, ensure_ascii=False) if result is not None else None)
+                    for key, (type_name, result) in items.items()
+                ]
+            )
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,120 @@
+import json
+import tempfile
+from typing import IO, BinaryIO, Iterator
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.utils import get_column_letter
+from src.utils.metrics import timed
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def iter_first_column(file: BinaryIO) -> Iterator:
+    """
+    Yields the non-empty values of the first column of the first sheet row by row,
+    without loading the whole workbook into memory.
+    """
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for (value,) in workbook.worksheets[0].iter_rows(min_col=1, max_col=1, values_only=True):
+            if value is not None and str(value).strip():
+                yield str(value).strip()
+    finally:
+        workbook.close()
+
+# Same look as the header row written by pandas
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="top")
+
+def cell_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+class NormalizedWorkbookWriter:
+    """
+    Builds the normalized workbook with a sheet per type. Each row holds the normalized attributes,
+    an empty separator column and the original text.
+
+    Rows are spooled to temporary files as they are added, only the column names and widths are kept in memory.
+    The columns of a sheet are known once all of its rows are added, so the workbook is written
+    in write-only mode by `finish`.
+    """
+
+    def __init__(self):
+        self.spools: dict[str, IO[str]] = {}
+        # type -> column -> widest value, columns in insertion order
+        self.widths: dict[str, dict[str, int]] = {}
+        self.original_widths: dict[str, int] = {}
+
+    def add(self, type_name: str, item: dict, original: str):
+        """
+        Rows of a sheet appear in the order they are added.
+        """
+        if type_name not in self.spools:
+            self.spools[type_name] = tempfile.TemporaryFile("w+", encoding="utf-8")
+            self.widths[type_name] = {}
+            self.original_widths[type_name] = 0
+
+        item = {key: cell_value(value) for key, value in item.items()}
+        self.spools[type_name].write(json.dumps([item, original], ensure_ascii=False) + "\n")
+
+        widths = self.widths[type_name]
+        for key, value in item.items():
+            widths[key] = max(widths.get(key, 0), len(str(value)))
+        self.original_widths[type_name] = max(self.original_widths[type_name], len(original))
+
+    def finish(self) -> IO[bytes]:
+        """
+        Writes the workbook to a temporary file and returns it positioned at the start.
+        """
+        output = tempfile.TemporaryFile()
+        with timed("xlsx_write"):
+            workbook = Workbook(write_only=True)
+            for type_name, spool in self.spools.items():
+                self._write_sheet(workbook.create_sheet(type_name), spool, self.widths[type_name], self.original_widths[type_name])
+            if not self.spools:
+                workbook.create_sheet()
+            workbook.save(output)
+        self.close()
+        output.seek(0)
+        return output
+
+    def close(self):
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
+
+    def _write_sheet(self, sheet, spool: IO[str], widths: dict[str, int], original_width: int):
+        keys = sorted(widths)  # Sort keys for consistent column order
+        column_order = keys + ["", "Оригинал"]
+
+        # Columns fit the longest value or the header, with a little extra width for padding
+        column_widths = [max(widths[key], len(key)) for key in keys] + [0, max(original_width, len("Оригинал"))]
+        for i, width in enumerate(column_widths):
+            sheet.column_dimensions[get_column_letter(i + 1)].width = width + 2
+
+        header = []
+        for column in column_order:
+            cell = WriteOnlyCell(sheet, value=column)
+            cell.font = HEADER_FONT
+            cell.border = HEADER_BORDER
+            cell.alignment = HEADER_ALIGNMENT
+            header.append(cell)
+        sheet.append(header)
+
+        spool.seek(0)
+        for line in spool:
+            item, original = json.loads(line)
+            sheet.append([item.get(key, "") for key in keys] + ["", original])
+
+def iter_file_chunks(file: IO[bytes], chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Reads a file in chunks for a streaming response and closes it at the end.
+    """
+    try:
+        while chunk := file.read(chunk_size):
+            yield chunk
+    finally:
+        file.close()
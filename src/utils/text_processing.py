@@ -3,4 +3,23 @@ def normalize_quotes_for_json(text: str) -> str:
     Replace curly quotes with straight quotes for JSON parsing.
     Converts both " and " to " to ensure valid JSON format.
     """
-    return text.replace('“', '"').replace('”', '"') 
\ No newline at end of file
+    return text.replace('“', '"').replace('”', '"')
+
+# Kept between digits, they make "3.5", "3-5" and "1/2" different numbers. A decimal comma is read as a point
+NUMBER_SEPARATORS = {".": ".", ",": ".", "-": "-", "/": "/"}
+
+def canonical_key(text: str) -> str:
+    """
+    Key under which texts differing only by case, whitespace or punctuation are considered the same item.
+    Punctuation inside numbers is kept, so "3,5x25" and "3.5x25" are one item but "3-5x25" is another.
+    """
+    text = text.lower()
+    chars = []
+    for i, char in enumerate(text):
+        if char.isalnum():
+            chars.append(char)
+        elif char in NUMBER_SEPARATORS and 0 < i < len(text) - 1 and text[i - 1].isdigit() and text[i + 1].isdigit():
+            chars.append(NUMBER_SEPARATORS[char])
+        else:
+            chars.append(" ")
+    return " ".join("".join(chars).split())
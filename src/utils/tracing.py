@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import random
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Share of LLM calls whose full prompt and answer are written to the trace, from 0 to 1
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Trace records go to this file as JSON lines, to the application log if empty
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+trace_logger = logging.getLogger("normalization.trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+_handler = logging.FileHandler(TRACE_FILE, encoding="utf-8") if TRACE_FILE else logging.StreamHandler()
+_handler.setFormatter(logging.Formatter("%(message)s"))
+trace_logger.addHandler(_handler)
+
+# Ids of the request or job being processed, attached to every trace record
+trace_ids: ContextVar[dict[str, str]] = ContextVar("trace_ids", default={})
+
+@contextmanager
+def trace_context(**ids: str):
+    token = trace_ids.set({**trace_ids.get(), **ids})
+    try:
+        yield
+    finally:
+        trace_ids.reset(token)
+
+def sampled() -> bool:
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+class TraceRecord:
+    """
+    Serialized to JSON only when the logging handler formats it.
+    """
+
+    def __init__(self, event: str, fields: dict):
+        self.event = event
+        self.fields = fields
+        self.ids = trace_ids.get()
+        self.time = datetime.now(timezone.utc)
+
+    def __str__(self) -> str:
+        return json.dumps(
+            {"time": self.time.isoformat(), "event": self.event, **self.ids, **self.fields},
+            ensure_ascii=False,
+            default=str
+        )
+
+def trace(event: str, **fields):
+    trace_logger.info("%s", TraceRecord(event, fields))